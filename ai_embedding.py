@@ -0,0 +1,137 @@
+import collections
+import hashlib
+import os
+import os.path as osp
+import threading
+
+import numpy as np
+
+from labelme.logger import logger
+
+
+class EmbeddingCache(object):
+    """Image embeddings of AI models, keyed by image content and model.
+
+    The max_entries most recently used embeddings are kept in memory.
+    With a directory, embeddings are also saved there as .npy files and
+    read back when they are no longer in memory.
+    """
+
+    def __init__(self, max_entries=16, directory=None):
+        self.max_entries = max_entries
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._memory = collections.OrderedDict()  # key=key, value=embedding
+
+    @staticmethod
+    def key(image, model_name):
+        image = np.ascontiguousarray(image)
+        digest = hashlib.sha1(model_name.encode("utf-8"))
+        digest.update(repr((image.shape, image.dtype.str)).encode("ascii"))
+        digest.update(image.data)
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return osp.join(self.directory, key + ".npy")
+
+    def get(self, key):
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                return self._memory[key]
+        if self.directory is None or not osp.exists(self._path(key)):
+            return None
+        try:
+            embedding = np.load(self._path(key), allow_pickle=False)
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring cached embedding %s: %s", key, e)
+            return None
+        self._remember(key, embedding)
+        return embedding
+
+    def put(self, key, embedding):
+        self._remember(key, embedding)
+        if self.directory is None or not isinstance(embedding, np.ndarray):
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            tmp_path = self._path(key) + ".tmp"
+            with open(tmp_path, "wb") as f:
+                np.save(f, embedding, allow_pickle=False)
+            os.replace(tmp_path, self._path(key))
+        except OSError as e:
+            logger.warning("Cannot cache embedding %s: %s", key, e)
+
+    def _remember(self, key, embedding):
+        with self._lock:
+            self._memory[key] = embedding
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+
+class _ModelEmbedding(object):
+    """Access to the image embedding of a labelme.ai model.
+
+    These models compute their embedding in set_image and keep it in
+    _image_embedding, guarded by _lock; _get_image_embedding waits for it.
+    They have no public API to read or set it, so every access to these
+    internals goes through this class, which checks that they all exist
+    first. Other models are embedded without caching.
+    """
+
+    _ATTRIBUTES = (
+        "_get_image_embedding",
+        "_image",
+        "_image_embedding",
+        "_lock",
+        "_thread",
+    )
+    _unsupported = set()  # names of the models already logged
+
+    def __init__(self, model):
+        self.model = model
+        missing = [a for a in self._ATTRIBUTES if not hasattr(model, a)]
+        self.supported = not missing
+        if missing and model.name not in self._unsupported:
+            self._unsupported.add(model.name)
+            logger.info(
+                "Not caching the embeddings of %r, which has no %s",
+                model.name,
+                ", ".join(missing),
+            )
+
+    def get(self):
+        if not self.supported:
+            return None
+        return self.model._get_image_embedding()
+
+    def set(self, image, embedding):
+        if not self.supported:
+            return False
+        with self.model._lock:
+            self.model._image = image
+            self.model._image_embedding = embedding
+        # Nothing is left to compute; _get_image_embedding returns as is.
+        self.model._thread = None
+        return True
+
+
+def embed_image(model, image, cache):
+    """Give image to model, reusing its cached embedding if any.
+
+    This blocks until the embedding is ready and is meant to run in a
+    worker thread.
+    """
+    access = _ModelEmbedding(model)
+    if not access.supported:
+        model.set_image(image=image)
+        return
+    key = cache.key(image, model.name)
+    embedding = cache.get(key)
+    if embedding is not None and access.set(image, embedding):
+        return
+    model.set_image(image=image)
+    embedding = access.get()
+    if embedding is not None:
+        cache.put(key, embedding)
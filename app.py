@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import collections
 import functools
 import html
 import math
@@ -32,8 +33,32 @@ from labelme.widgets import LabelListWidgetItem
 from labelme.widgets import ToolBar
 from labelme.widgets import UniqueLabelQListWidget
 from labelme.widgets import ZoomWidget
-
+from labelme.widgets.file_list import FileListModel
+from labelme.widgets.file_list import FileListView
+from labelme.widgets.file_list import LabelStatus
+from labelme.widgets.image_adjust import ImageAdjustment
+from labelme.widgets.patch_labels import CLASS_RGB
+from labelme.widgets.patch_labels import INTENSITY_ALPHA
+from labelme.widgets.patch_labels import label_color
+from labelme.widgets.patch_labels import make_label
+
+from . import edit_journal
 from . import utils
+from .dir_index import DirectoryIndex
+from .dir_index import DirectoryIndexer
+from .dir_index import filename_matcher
+from .edit_journal import EditJournal
+from .image_prefetcher import ImagePrefetcher
+from .image_prefetcher import label_file_path
+from .image_prefetcher import neighbours
+from .label_writer import LabelJob
+from .label_writer import LabelWriter
+from .patch_codec import PATCH_ENCODINGS
+from .patch_codec import encode_patch
+from .spill_store import ARRAY_CODEC
+from .spill_store import JSON_CODEC
+from .spill_store import PIXMAP_CODEC
+from .spill_store import SpillStore
 
 # FIXME
 # - [medium] Set max zoom value to something big enough for FitWidth/Window
@@ -50,10 +75,12 @@ class MainWindow(QtWidgets.QMainWindow):
 
     patchSizeChanged = QtCore.Signal(int, int)
     temp_shape_data=None
-    queue_label={}
-    queue_img={}
+    # Unsaved per-image state; values over the memory budget are spilled
+    # to a session directory (see __init__ for the budget).
+    queue_label=SpillStore(JSON_CODEC)
+    queue_img=SpillStore(PIXMAP_CODEC)
     queue_img_name={}
-    queue_patch={}
+    queue_patch=SpillStore(ARRAY_CODEC)  # mask arrays, see Canvas.mask_label
     queue_img_size={}
     checked_json=[]
 
@@ -153,14 +180,15 @@ class MainWindow(QtWidgets.QMainWindow):
 
         # Create class labels
         self.class_labels = []
+        # Colors come from the lookup table the canvas overlay is drawn with.
         self.class_color_map = {
             "CLEAN": QtGui.QColor(0, 0, 0),
-            "class1": QtGui.QColor(0, 255, 255),
-            "class2": QtGui.QColor(255, 255, 0),
-            "class3": QtGui.QColor(0, 0, 255),
-            #"class4": QtGui.QColor(0, 255, 0),
-            #"class5": QtGui.QColor(255, 0, 255),
-            #"class6": QtGui.QColor(255, 0, 0),
+            "class1": QtGui.QColor(*CLASS_RGB[1]),
+            "class2": QtGui.QColor(*CLASS_RGB[2]),
+            "class3": QtGui.QColor(*CLASS_RGB[3]),
+            #"class4": QtGui.QColor(*CLASS_RGB[4]),
+            #"class5": QtGui.QColor(*CLASS_RGB[5]),
+            #"class6": QtGui.QColor(*CLASS_RGB[6]),
         }
         self.class_idx_list=list(self.class_color_map.keys())
 
@@ -186,8 +214,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.intensity_labels = []
         self.intensity_color_map = {
             "CLEAN": 0,
-            "BLURRY": 40,
-            "BLOCKAGE": 180,
+            "BLURRY": INTENSITY_ALPHA[1],
+            "BLOCKAGE": INTENSITY_ALPHA[2],
         }
         self.intensity_key_list=list(self.intensity_color_map.keys())
 
@@ -249,8 +277,23 @@ class MainWindow(QtWidgets.QMainWindow):
         self.fileSearch = QtWidgets.QLineEdit()
         self.fileSearch.setPlaceholderText(self.tr("Search Filename"))
         self.fileSearch.textChanged.connect(self.fileSearchChanged)
-        self.fileListWidget = QtWidgets.QListWidget()
-        self.fileListWidget.itemSelectionChanged.connect(self.fileSelectionChanged)
+        # The search is applied once typing pauses.
+        self._file_search_timer = QtCore.QTimer(self)
+        self._file_search_timer.setSingleShot(True)
+        self._file_search_timer.setInterval(150)
+        self._file_search_timer.timeout.connect(self.applyFileSearch)
+        # Whether images are labeled is resolved when their rows are shown.
+        self.labelStatus = LabelStatus(parent=self)
+        self.labelStatus.failed.connect(
+            lambda message: self.status(
+                str(self.tr("Failed to check the label files: %s")) % message
+            )
+        )
+        self.fileListModel = FileListModel(self.labelStatus, self)
+        self.fileListWidget = FileListView(self.fileListModel)
+        self.fileListWidget.selectionModel().selectionChanged.connect(
+            self.fileSelectionChanged
+        )
         fileListLayout = QtWidgets.QVBoxLayout()
         fileListLayout.setContentsMargins(0, 0, 0, 0)
         fileListLayout.setSpacing(0)
@@ -270,11 +313,26 @@ class MainWindow(QtWidgets.QMainWindow):
             epsilon=self._config["epsilon"],
             double_click=self._config["canvas"]["double_click"],
             num_backups=self._config["canvas"]["num_backups"],
+            compact_patch_strokes=self._config["canvas"].get(
+                "compact_patch_strokes", False
+            ),
+            ai_embedding_cache_size=self._config["canvas"].get(
+                "ai_embedding_cache_size", 16
+            ),
+            ai_embedding_cache_dir=self._config["canvas"].get(
+                "ai_embedding_cache_dir", None
+            ),
+            undo_memory_limit=self._config["canvas"].get(
+                "undo_memory_limit", 64 * 1024 * 1024
+            ),
             crosshair=self._config["canvas"]["crosshair"],
         )
         self.canvas.classAndIntensityChanged.connect(self.updateClassAndIntensity)
         self.canvas.zoomRequest.connect(self.zoomRequest)
         self.patchSizeChanged.connect(self.canvas.update_patch_size)
+        self.canvas.edited.connect(self.journalEdit)
+        self.canvas.undone.connect(self.journalUndo)
+        self.canvas.maskReset.connect(self.journalSnapshot)
 
         scrollArea = QtWidgets.QScrollArea()
         scrollArea.setWidget(self.canvas)
@@ -966,6 +1024,43 @@ class MainWindow(QtWidgets.QMainWindow):
             )
         self.output_file = output_file
         self.output_dir = output_dir
+        # Images next to the current one are decoded in the background.
+        self._prefetch_next = self._config.get("prefetch_next", 3)
+        self._prefetch_prev = self._config.get("prefetch_prev", 1)
+        self._prefetcher = ImagePrefetcher(
+            max_entries=self._prefetch_next + self._prefetch_prev + 2
+        )
+        # "list" (nested lists) or "rle" (see patch_codec); both are read.
+        self._patch_encoding = self._config.get("patch_encoding", "list")
+        if self._patch_encoding not in PATCH_ENCODINGS:
+            logger.error(
+                "Unknown patch_encoding %r, using 'list' instead",
+                self._patch_encoding,
+            )
+            self._patch_encoding = "list"
+        # Queued label files are written in the background.
+        self.labelWriter = LabelWriter(parent=self)
+        self.labelWriter.written.connect(self.onLabelWritten)
+        self.labelWriter.failed.connect(self.onLabelWriteFailed)
+        self.labelWriter.progress.connect(self.onLabelWriteProgress)
+        self._label_write_errors = []
+        # key=image, value=journal marks of its pending writes, in order
+        self._label_write_marks = collections.defaultdict(collections.deque)
+        # Edits are journaled per image directory until they are saved.
+        self.journal = None
+        self._journal_timer = QtCore.QTimer(self)
+        self._journal_timer.setInterval(1000)
+        self._journal_timer.timeout.connect(self.syncJournal)
+        self._journal_timer.start()
+        # Image directories are listed from a cached index, revalidated in
+        # the background.
+        self._dir_filenames = []
+        self.dirIndexer = DirectoryIndexer(parent=self)
+        self.dirIndexer.scanned.connect(self.onDirIndexScanned)
+        queue_memory_limit = self._config.get("queue_memory_limit", 512 * 1024 * 1024)
+        MainWindow.queue_img.max_nbytes = queue_memory_limit // 2
+        MainWindow.queue_patch.max_nbytes = queue_memory_limit // 4
+        MainWindow.queue_label.max_nbytes = queue_memory_limit // 4
 
         # Application state.
         self.image = QtGui.QImage()
@@ -977,6 +1072,8 @@ class MainWindow(QtWidgets.QMainWindow):
         self.fit_window = False
         self.zoom_values = {}  # key=filename, value=(zoom_mode, zoom_value)
         self.brightnessContrast_values = {}
+        # Brightness/contrast of the loaded image, applied without a dialog.
+        self.adjustment = ImageAdjustment(self.onNewBrightnessContrast, parent=self)
         self.scroll_values = {
             Qt.Horizontal: {},
             Qt.Vertical: {},
@@ -1042,18 +1139,18 @@ class MainWindow(QtWidgets.QMainWindow):
     def updateSelectionColor(self):
         selected_class = self.class_combo.currentText()
         selected_intensity = self.intensity_combo.currentText()
+        rgba = label_color(make_label(selected_class, selected_intensity))
+        if selected_class == "CLEAN" or rgba is None:
+            selected_color = QtGui.QColor(192, 192, 192)  # Gray color for CLEAN
+        else:
+            selected_color = QtGui.QColor(*rgba)
 
         # Update class labels
         for label in self.class_labels:
             class_id = label.text()
             palette = label.palette()
             if class_id == selected_class:
-                color = self.class_color_map[class_id]
-                if selected_class == "CLEAN":
-                    color = QtGui.QColor(192, 192, 192)  # Gray color for CLEAN
-                else:
-                    color.setAlpha(self.intensity_color_map.get(selected_intensity, 255))
-                palette.setColor(QtGui.QPalette.Window, color)
+                palette.setColor(QtGui.QPalette.Window, selected_color)
             else:
                 palette.setColor(QtGui.QPalette.Window, QtGui.QColor(192, 192, 192))
             label.setPalette(palette)
@@ -1063,12 +1160,7 @@ class MainWindow(QtWidgets.QMainWindow):
             intensity = label.text()
             palette = label.palette()
             if intensity == selected_intensity:
-                if selected_class == "CLEAN":
-                    color = QtGui.QColor(192, 192, 192)  # Gray color for CLEAN
-                else:
-                    color = self.class_color_map[selected_class]
-                    color.setAlpha(self.intensity_color_map.get(intensity, 255))
-                palette.setColor(QtGui.QPalette.Window, color)
+                palette.setColor(QtGui.QPalette.Window, selected_color)
             else:
                 gray = QtGui.QColor(192, 192, 192)
                 gray.setAlpha(self.intensity_color_map.get(intensity, 255))
@@ -1316,6 +1408,7 @@ class MainWindow(QtWidgets.QMainWindow):
             )
             return
         shape.label = text
+        self.canvas.touchShape(shape)
         shape.flags = flags
         shape.group_id = group_id
         shape.description = description
@@ -1337,24 +1430,26 @@ class MainWindow(QtWidgets.QMainWindow):
             self.uniqLabelList.setItemLabel(item, shape.label, rgb)
 
     def fileSearchChanged(self):
-        self.importDirImages(
-            self.lastOpenDir,
-            pattern=self.fileSearch.text(),
-            load=False,
-        )
+        self._file_search_timer.start()
+
+    def applyFileSearch(self):
+        if not self.lastOpenDir:
+            return
+        self.populateFileList(self.fileSearch.text())
+        row = self.fileListModel.findRow(self.filename)
+        if row >= 0:
+            self.fileListWidget.setCurrentRow(row, notify=False)
+        elif self.mayContinue():
+            self.filename = None
+            self.openNextImg(load=False)
 
     def fileSelectionChanged(self):
-        items = self.fileListWidget.selectedItems()
-        if not items:
+        filename = self.fileListWidget.selectedFilename()
+        if not filename:
             return
-        item = items[0]
         if not self.mayContinue():
             return
-        currIndex = self.imageList.index(str(item.text()))
-        if currIndex < len(self.imageList):
-            filename = self.imageList[currIndex]
-            if filename:
-                self.loadFile(filename)
+        self.loadFile(filename)
 
     # React to canvas signals.
     def shapeSelectionChanged(self, selected_shapes):
@@ -1459,7 +1554,22 @@ class MainWindow(QtWidgets.QMainWindow):
             flags = shape["flags"]
             description = shape.get("description", "")
             group_id = shape["group_id"]
-            #other_data = shape["other_data"]
+            other_data = shape.get("other_data")
+            if other_data is None:
+                # Shapes queued by formatShape keep extra fields at the top level.
+                other_data = {
+                    k: v
+                    for k, v in shape.items()
+                    if k not in (
+                        "label",
+                        "points",
+                        "group_id",
+                        "shape_type",
+                        "flags",
+                        "description",
+                        "mask",
+                    )
+                }
 
             if not points:
                 # skip point-empty shape
@@ -1484,7 +1594,7 @@ class MainWindow(QtWidgets.QMainWindow):
                             default_flags[key] = False
             shape.flags = default_flags
             shape.flags.update(flags)
-            #shape.other_data = other_data
+            shape.other_data = other_data
 
             s.append(shape)
         self.loadShapes(s)
@@ -1504,23 +1614,28 @@ class MainWindow(QtWidgets.QMainWindow):
             item.setCheckState(Qt.Checked if flag else Qt.Unchecked)
             self.flag_widget.addItem(item)
 
+    def formatShape(self, s):
+        data = s.other_data.copy()
+        data.pop("patch_cells", None)
+        data.pop("patch_grid", None)
+        data.update(
+            dict(
+                label=s.label.encode("utf-8") if PY2 else s.label,
+                points=[(p.x(), p.y()) for p in s.points],
+                group_id=s.group_id,
+                description=s.description,
+                shape_type=s.shape_type,
+                flags=s.flags,
+                mask=None if s.mask is None else utils.img_arr_to_b64(s.mask),
+            )
+        )
+        if s.shape_type == "patch_annotation":
+            data.update(self.canvas.patchCellsData(s))
+        return data
+
     def saveLabels(self, filename):
         lf = LabelFile()
-        def format_shape(s):
-            data = s.other_data.copy()
-            data.update(
-                dict(
-                    label=s.label.encode("utf-8") if PY2 else s.label,
-                    points=[(p.x(), p.y()) for p in s.points],
-                    group_id=s.group_id,
-                    description=s.description,
-                    shape_type=s.shape_type,
-                    flags=s.flags,
-                    mask=None if s.mask is None else utils.img_arr_to_b64(s.mask),
-                )
-            )
-            return data
-        shapes = [format_shape(item.shape()) for item in self.labelList]
+        shapes = [self.formatShape(item.shape()) for item in self.labelList]
         #shapes = [[format_shape(item.shape()) for item in self.labelList][-1]]
 
         flags = {}
@@ -1536,7 +1651,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 os.makedirs(osp.dirname(filename))
             lf.save(
                 filename=filename,
-                patch=self.canvas.get_mask_label(),
+                patch=encode_patch(self.canvas.mask_label.array, self._patch_encoding),
                 shapes=shapes,
                 imagePath=imagePath,
                 imageData=imageData,
@@ -1546,11 +1661,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 flags=flags,
             )
             self.labelFile = lf
-            items = self.fileListWidget.findItems(self.imagePath, Qt.MatchExactly)
-            if len(items) > 0:
-                if len(items) != 1:
-                    raise RuntimeError("There are duplicate files.")
-                items[0].setCheckState(Qt.Checked)
+            self.fileListModel.setChecked(self.imagePath, True)
             # disable allows next and previous image to proceed
             # self.filename = filename
             return True
@@ -1559,49 +1670,76 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.tr("Error saving label data"), self.tr("<b>%s</b>") % e
             )
             return False
-    def queue_saveLabels(self, filename):
-        lf = LabelFile()
-        img_name = osp.splitext(filename)[0] + ".jpg"
-        
-        shapes = MainWindow.queue_label[img_name]
-        #shapes = [[format_shape(item.shape()) for item in self.labelList][-1]]
+    def queueLabelJob(self, img_name, flags):
+        """Return the LabelJob writing the queued labels of img_name.
 
-        flags = {}
-        for i in range(self.flag_widget.count()):
-            item = self.flag_widget.item(i)
-            key = item.text()
-            flag = item.checkState() == Qt.Checked
-            flags[key] = flag
-        try:
-            imagePath = osp.relpath(img_name, osp.dirname(filename))
-            imageData = self.imageData if self._config["store_data"] else None
-            if osp.dirname(filename) and not osp.exists(osp.dirname(filename)):
-                os.makedirs(osp.dirname(filename))
-            lf.save(
-                filename=filename,
-                patch=MainWindow.queue_patch[img_name],
-                shapes=shapes,
-                imagePath=imagePath,
-                imageData=imageData,
-                imageHeight=MainWindow.queue_img_size[img_name][0],
-                imageWidth=MainWindow.queue_img_size[img_name][1],
+        Its labels are taken out of the queue; spilled ones are only read
+        back by the writer, one file at a time.
+        """
+        filename = osp.splitext(img_name)[0] + ".json"
+        height, width = MainWindow.queue_img_size[img_name]
+        load_patch = MainWindow.queue_patch.take(img_name)
+        encoding = self._patch_encoding
+        return LabelJob(
+            image_filename=img_name,
+            label_file=filename,
+            kwargs=dict(
+                imagePath=osp.relpath(img_name, osp.dirname(filename)),
+                imageData=None,
+                imageHeight=height,
+                imageWidth=width,
                 otherData=self.otherData,
                 flags=flags,
-            )
-            self.labelFile = lf
-            items = self.fileListWidget.findItems(self.imagePath, Qt.MatchExactly)
-            if len(items) > 0:
-                if len(items) != 1:
-                    raise RuntimeError("There are duplicate files.")
-                items[0].setCheckState(Qt.Checked)
-            # disable allows next and previous image to proceed
-            # self.filename = filename
-            return True
-        except LabelFileError as e:
-            self.errorMessage(
-                self.tr("Error saving label data"), self.tr("<b>%s</b>") % e
-            )
-            return False
+            ),
+            loaders=dict(
+                patch=lambda: encode_patch(load_patch(), encoding),
+                shapes=MainWindow.queue_label.take(img_name),
+            ),
+            store_data=self._config["store_data"],
+        )
+
+    def onLabelWritten(self, img_name, filename):
+        # Writes of an image finish in the order they were submitted.
+        journal, mark = self._label_write_marks[img_name].popleft()
+        if journal is not None and journal is self.journal:
+            # Its edits up to the save are in the label file now; they are
+            # dropped right away, so that a crash later in the batch does
+            # not replay them over the saved state.
+            journal.discard({img_name: mark})
+        if (
+            img_name == self.filename
+            and not self._label_write_marks[img_name]
+            and (journal is None or journal.lastSeq() == mark)
+        ):
+            # The last write of the current image holds all its edits.
+            self.setClean()
+        self.addRecentFile(filename)
+        self.fileListModel.setChecked(img_name, True)
+        if img_name == self.filename:
+            self.showCanvasThumbnail()
+
+    def onLabelWriteFailed(self, img_name, error):
+        self._label_write_marks[img_name].popleft()
+        self._label_write_errors.append((img_name, error))
+
+    def onLabelWriteProgress(self, done, total):
+        if done < total:
+            self.status(str(self.tr("Saving labels %d/%d")) % (done, total))
+            return
+        errors, self._label_write_errors = self._label_write_errors, []
+        if not errors:
+            self.status(str(self.tr("Saved %d label files")) % total)
+            return
+        self.status(
+            str(self.tr("Failed to save %d of %d label files")) % (len(errors), total)
+        )
+        self.errorMessage(
+            self.tr("Error saving label data"),
+            "<br/>".join(
+                "<b>%s</b>: %s" % (html.escape(osp.basename(f)), html.escape(e))
+                for f, e in errors
+            ),
+        )
 
     def duplicateSelectedShape(self):
         added_shapes = self.canvas.duplicateSelectedShapes()
@@ -1675,27 +1813,7 @@ class MainWindow(QtWidgets.QMainWindow):
             #print("corruption :",self.intensity_combo.currentText())
             class_text = self.class_combo.currentText()
             intensity_text = self.intensity_combo.currentText()
-            class_map = {
-                "CLEAN": "00",
-                "class1": "1",
-                "class2": "2",
-                "class3": "3",
-                #"class4": "4",
-                #"class5": "5",
-                #"class6": "6"
-            }
-            intensity_map = {
-                "CLEAN": "",
-                "BLURRY": "q",
-                "BLOCKAGE": "w"
-            }
-
-            class_label = class_map.get(class_text, "")
-
-            intensity_label = intensity_map.get(intensity_text, "")
-
-            patch_label = class_label + intensity_label
-            text = patch_label
+            text = patch_label = make_label(class_text, intensity_text)
 
         elif self._config["display_label_popup"] or not text:
             previous_text = self.labelDialog.edit.text()
@@ -1723,7 +1841,6 @@ class MainWindow(QtWidgets.QMainWindow):
             self.setDirty()
         else:
             self.canvas.undoLastLine()
-            self.canvas.shapesBackups.pop()
 
     def scrollRequest(self, delta, orientation):
         units = -delta * 0.1  # natural scroll
@@ -1790,13 +1907,14 @@ class MainWindow(QtWidgets.QMainWindow):
         self.actions.keepPrevScale.setChecked(enabled)
 
     def onNewBrightnessContrast(self, qimage):
-        self.canvas.loadPixmap(QtGui.QPixmap.fromImage(qimage), clear_shapes=False)
+        self.canvas.setDisplayPixmap(QtGui.QPixmap.fromImage(qimage))
 
     def brightnessContrast(self, value):
         dialog = BrightnessContrastDialog(
-            utils.img_data_to_pil(self.imageData),
+            self.adjustment.engine(),
             self.onNewBrightnessContrast,
             parent=self,
+            scale=self.canvas.scale,
         )
         brightness, contrast = self.brightnessContrast_values.get(
             self.filename, (None, None)
@@ -1810,6 +1928,8 @@ class MainWindow(QtWidgets.QMainWindow):
         brightness = dialog.slider_brightness.value()
         contrast = dialog.slider_contrast.value()
         self.brightnessContrast_values[self.filename] = (brightness, contrast)
+        self.adjustment.brightness = brightness
+        self.adjustment.contrast = contrast
 
     def togglePolygons(self, value):
         flag = value
@@ -1822,10 +1942,9 @@ class MainWindow(QtWidgets.QMainWindow):
         """Load the specified file, or the last opened file if None."""
             
         # changing fileListWidget loads file
-        if filename in self.imageList and (
-            self.fileListWidget.currentRow() != self.imageList.index(filename)
-        ):
-            self.fileListWidget.setCurrentRow(self.imageList.index(filename))
+        row = self.fileListModel.findRow(filename)
+        if row >= 0 and self.fileListWidget.currentRow() != row:
+            self.fileListWidget.setCurrentRow(row)
             self.fileListWidget.repaint()
             return
         self.no_jsonfile=False
@@ -1842,17 +1961,19 @@ class MainWindow(QtWidgets.QMainWindow):
             return False
         # assumes same name, but json extension
         self.status(str(self.tr("Loading %s...")) % osp.basename(str(filename)))
-        label_file = osp.splitext(filename)[0] + ".json"
-        if self.output_dir:
-            label_file_without_path = osp.basename(label_file)
-            label_file = osp.join(self.output_dir, label_file_without_path)
+        label_file = label_file_path(filename, self.output_dir)
+        prefetched = self._prefetcher.take(filename, label_file)
         
         if filename in MainWindow.queue_label:
-            self.imageData = LabelFile.load_image_file(filename)
+            if prefetched:
+                self.imageData = prefetched.image_data
+                image = prefetched.image
+            else:
+                self.imageData = LabelFile.load_image_file(filename)
+                image = QtGui.QImage.fromData(self.imageData)
             if self.imageData:
                 self.imagePath = filename
             self.labelFile = MainWindow.queue_label[filename]
-            image = QtGui.QImage.fromData(self.imageData)
 
             if image.isNull():
                 formats = [
@@ -1879,7 +2000,19 @@ class MainWindow(QtWidgets.QMainWindow):
                 #if self.labelFile.flags is not None:
                 #    flags.update(self.labelFile.flags)
         else:
-            if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(label_file):
+            if prefetched and prefetched.label_file:
+                self.labelFile = prefetched.label_file
+                self.imageData = self.labelFile.imageData
+                self.imagePath = osp.join(
+                    osp.dirname(label_file),
+                    self.labelFile.imagePath,
+                )
+                self.otherData = self.labelFile.otherData
+            elif prefetched:
+                self.imageData = prefetched.image_data
+                self.imagePath = filename
+                self.labelFile = None
+            elif QtCore.QFile.exists(label_file) and LabelFile.is_label_file(label_file):
                 try:
                     self.labelFile = LabelFile(label_file)
                 except LabelFileError as e:
@@ -1904,7 +2037,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 if self.imageData:
                     self.imagePath = filename
                 self.labelFile = None
-            image = QtGui.QImage.fromData(self.imageData)
+            image = prefetched.image if prefetched else QtGui.QImage.fromData(self.imageData)
 
             if image.isNull():
                 formats = [
@@ -1951,11 +2084,7 @@ class MainWindow(QtWidgets.QMainWindow):
                     orientation, self.scroll_values[orientation][self.filename]
                 )
         # set brightness contrast values
-        dialog = BrightnessContrastDialog(
-            utils.img_data_to_pil(self.imageData),
-            self.onNewBrightnessContrast,
-            parent=self,
-        )
+        self.adjustment.setImage(self.image)
         brightness, contrast = self.brightnessContrast_values.get(
             self.filename, (None, None)
         )
@@ -1967,13 +2096,9 @@ class MainWindow(QtWidgets.QMainWindow):
             _, contrast = self.brightnessContrast_values.get(
                 self.recentFiles[0], (None, None)
             )
-        if brightness is not None:
-            dialog.slider_brightness.setValue(brightness)
-        if contrast is not None:
-            dialog.slider_contrast.setValue(contrast)
         self.brightnessContrast_values[self.filename] = (brightness, contrast)
         if brightness is not None or contrast is not None:
-            dialog.onNewValue(None)
+            self.adjustment.setValues(brightness, contrast)
         self.paintCanvas()
         self.addRecentFile(self.filename)
         self.toggleActions(True)
@@ -2009,8 +2134,24 @@ class MainWindow(QtWidgets.QMainWindow):
             MainWindow.queue_img[self.filename] = self.scaled_pixmap
             MainWindow.checked_json.append(filename)
 
+        self.prefetchNeighbours()
         return True
 
+    def prefetchNeighbours(self):
+        """Start decoding the images around the current one."""
+        row = self.fileListModel.findRow(self.filename)
+        if row < 0:
+            return
+        filenames = neighbours(
+            self.imageList,
+            row,
+            self._prefetch_next,
+            self._prefetch_prev,
+        )
+        self._prefetcher.prefetch(
+            [(f, label_file_path(f, self.output_dir)) for f in filenames]
+        )
+
     def resizeEvent(self, event):
         if (
             self.canvas
@@ -2072,10 +2213,8 @@ class MainWindow(QtWidgets.QMainWindow):
             # Check for arrow keys to adjust values
             if hasattr(self, 'brightness_key_pressed') and self.brightness_key_pressed:
                 if event.key() == QtCore.Qt.Key_Up or event.key() == QtCore.Qt.Key_Down:
-                    # Get current values or use defaults
-                    brightness, contrast = self.brightnessContrast_values.get(
-                        self.filename, (50, 50)
-                    )
+                    # Get current values
+                    brightness, contrast = self.adjustment.values()
                     
                     # Adjust brightness
                     if event.key() == QtCore.Qt.Key_Up:
@@ -2083,24 +2222,16 @@ class MainWindow(QtWidgets.QMainWindow):
                     else:  # Down arrow
                         brightness = max(0, brightness - 5)
                         
-                    # Update values and apply changes
+                    # Update values and apply changes, once per frame
+                    # when the key auto-repeats
                     self.brightnessContrast_values[self.filename] = (brightness, contrast)
-                    dialog = BrightnessContrastDialog(
-                        utils.img_data_to_pil(self.imageData),
-                        self.onNewBrightnessContrast,
-                        parent=self,
-                    )
-                    dialog.slider_brightness.setValue(brightness)
-                    dialog.slider_contrast.setValue(contrast)
-                    dialog.onNewValue(None)
+                    self.adjustment.setValues(brightness, contrast, coalesce=True)
                     return
                     
             if hasattr(self, 'contrast_key_pressed') and self.contrast_key_pressed:
                 if event.key() == QtCore.Qt.Key_Up or event.key() == QtCore.Qt.Key_Down:
-                    # Get current values or use defaults
-                    brightness, contrast = self.brightnessContrast_values.get(
-                        self.filename, (50, 50)
-                    )
+                    # Get current values
+                    brightness, contrast = self.adjustment.values()
                     
                     # Adjust contrast
                     if event.key() == QtCore.Qt.Key_Up:
@@ -2108,16 +2239,10 @@ class MainWindow(QtWidgets.QMainWindow):
                     else:  # Down arrow
                         contrast = max(0, contrast - 5)
                         
-                    # Update values and apply changes
+                    # Update values and apply changes, once per frame
+                    # when the key auto-repeats
                     self.brightnessContrast_values[self.filename] = (brightness, contrast)
-                    dialog = BrightnessContrastDialog(
-                        utils.img_data_to_pil(self.imageData),
-                        self.onNewBrightnessContrast,
-                        parent=self,
-                    )
-                    dialog.slider_brightness.setValue(brightness)
-                    dialog.slider_contrast.setValue(contrast)
-                    dialog.onNewValue(None)
+                    self.adjustment.setValues(brightness, contrast, coalesce=True)
                     return
                     
         super(MainWindow, self).keyPressEvent(event)
@@ -2138,6 +2263,24 @@ class MainWindow(QtWidgets.QMainWindow):
         self.settings.setValue("window/position", self.pos())
         self.settings.setValue("window/state", self.saveState())
         self.settings.setValue("recentFiles", self.recentFiles)
+        if event.isAccepted():
+            self._prefetcher.shutdown()
+            self.dirIndexer.shutdown()
+            self.labelStatus.shutdown()
+            if self.labelWriter.isBusy():
+                # Closing waits for the queued label files to be written.
+                self.status(self.tr("Writing label files..."))
+                QtWidgets.QApplication.setOverrideCursor(Qt.WaitCursor)
+                QtWidgets.QApplication.processEvents()
+                try:
+                    self.labelWriter.shutdown()
+                finally:
+                    QtWidgets.QApplication.restoreOverrideCursor()
+            else:
+                self.labelWriter.shutdown()
+            # Deliver the signals of the last writes before compacting.
+            QtWidgets.QApplication.processEvents()
+            self.closeJournal()
         # ask the use for where to save the labels
         # self.settings.setValue('window/geometry', self.saveGeometry())
 
@@ -2182,28 +2325,13 @@ class MainWindow(QtWidgets.QMainWindow):
         if self.filename is None:
             return
         
-        def format_shape(s):
-            data = s.other_data.copy()
-            data.update(
-                dict(
-                    label=s.label.encode("utf-8") if PY2 else s.label,
-                    points=[(p.x(), p.y()) for p in s.points],
-                    group_id=s.group_id,
-                    description=s.description,
-                    shape_type=s.shape_type,
-                    flags=s.flags,
-                    mask=None if s.mask is None else utils.img_arr_to_b64(s.mask),
-                )
-            )
-            return data
-        currIndex = self.imageList.index(self.filename)
+        currIndex = self.fileListModel.findRow(self.filename)
         MainWindow.queue_img_size[self.filename] = [self.image.height(), self.image.width()]
-        MainWindow.queue_label[self.filename] = [format_shape(item.shape()) for item in self.labelList]
+        MainWindow.queue_label[self.filename] = [self.formatShape(item.shape()) for item in self.labelList]
         if currIndex - 1 >= 0:
-            MainWindow.queue_patch[self.filename] = self.canvas.get_mask_label()
-            if len([format_shape(item.shape()) for item in self.labelList]) > 0:
-                items = self.fileListWidget.findItems(self.filename, Qt.MatchExactly)
-                items[0].setCheckState(Qt.Checked)
+            MainWindow.queue_patch[self.filename] = self.canvas.mask_label.array.copy()
+            if len([self.formatShape(item.shape()) for item in self.labelList]) > 0:
+                self.fileListModel.setChecked(self.filename, True)
             filename = self.imageList[currIndex - 1]
             self.filename = filename
             if filename:
@@ -2225,35 +2353,20 @@ class MainWindow(QtWidgets.QMainWindow):
         if len(self.imageList) <= 0:
             return
 
-        def format_shape(s):
-            data = s.other_data.copy()
-            data.update(
-                dict(
-                    label=s.label.encode("utf-8") if PY2 else s.label,
-                    points=[(p.x(), p.y()) for p in s.points],
-                    group_id=s.group_id,
-                    description=s.description,
-                    shape_type=s.shape_type,
-                    flags=s.flags,
-                    mask=None if s.mask is None else utils.img_arr_to_b64(s.mask),
-                )
-            )
-            return data
         MainWindow.queue_img_size[self.filename] = [self.image.height(), self.image.width()]
-        MainWindow.queue_label[self.filename] = [format_shape(item.shape()) for item in self.labelList]
+        MainWindow.queue_label[self.filename] = [self.formatShape(item.shape()) for item in self.labelList]
         filename = None
         if self.filename is None:
             filename = self.imageList[0]
         else:
-            currIndex = self.imageList.index(self.filename)
+            currIndex = self.fileListModel.findRow(self.filename)
             if currIndex + 1 < len(self.imageList):
                 filename = self.imageList[currIndex + 1]
             else:
                 filename = self.imageList[-1]
-            MainWindow.queue_patch[self.filename] = self.canvas.get_mask_label()
-            if len([format_shape(item.shape()) for item in self.labelList]) > 0:
-                items = self.fileListWidget.findItems(self.filename, Qt.MatchExactly)
-                items[0].setCheckState(Qt.Checked)
+            MainWindow.queue_patch[self.filename] = self.canvas.mask_label.array.copy()
+            if len([self.formatShape(item.shape()) for item in self.labelList]) > 0:
+                self.fileListModel.setChecked(self.filename, True)
                 
         self.filename = filename
         if self.filename and load:
@@ -2312,40 +2425,23 @@ class MainWindow(QtWidgets.QMainWindow):
         )
         self.statusBar().show()
 
-        current_filename = self.filename
-        self.importDirImages(self.lastOpenDir, load=False)
-
-        if current_filename in self.imageList:
-            # retain currently selected file
-            self.fileListWidget.setCurrentRow(self.imageList.index(current_filename))
-            self.fileListWidget.repaint()
-            
+        # Only the check marks depend on output_dir; the list is kept.
+        self.scanLabelStatus()
+        if self.filename and self.mayContinue():
+            # reload the labels of the current file from output_dir
+            self.loadFile(self.filename)
 
     def saveFile(self, _value=False):
         assert not self.image.isNull(), "cannot save empty image"
-        def format_shape(s):
-            data = s.other_data.copy()
-            data.update(
-                dict(
-                    label=s.label.encode("utf-8") if PY2 else s.label,
-                    points=[(p.x(), p.y()) for p in s.points],
-                    group_id=s.group_id,
-                    description=s.description,
-                    shape_type=s.shape_type,
-                    flags=s.flags,
-                    mask=None if s.mask is None else utils.img_arr_to_b64(s.mask),
-                )
-            )
-            return data
         
         if self.filename not in MainWindow.queue_label:
             MainWindow.queue_img_size[self.filename] = [self.image.height(), self.image.width()]
-            MainWindow.queue_label[self.filename] = [format_shape(item.shape()) for item in self.labelList]
-            MainWindow.queue_patch[self.filename] = self.canvas.get_mask_label()
+            MainWindow.queue_label[self.filename] = [self.formatShape(item.shape()) for item in self.labelList]
+            MainWindow.queue_patch[self.filename] = self.canvas.mask_label.array.copy()
         
         if bool(MainWindow.queue_label):
             self.queue_saveFile()
-            for k in MainWindow.queue_img.keys():
+            for k in list(MainWindow.queue_img.keys()):
                 MainWindow.checked_json.remove(k)
             MainWindow.queue_label.clear()
             MainWindow.queue_img.clear()
@@ -2438,33 +2534,47 @@ class MainWindow(QtWidgets.QMainWindow):
             self.setClean()
 
     def queue_saveFile(self):
-        for filename in MainWindow.queue_label.keys():
-            if filename is not None:
-                filename = osp.splitext(filename)[0] + ".json"
-                if self.queue_saveLabels(filename):
-                    #filename = osp.splitext(filename)[0] + ".json"
-                    self.addRecentFile(filename)
-                    self.setClean()
-
-        label_file = osp.splitext(self.filename)[0] + ".json"
+        flags = {}
+        for i in range(self.flag_widget.count()):
+            item = self.flag_widget.item(i)
+            flags[item.text()] = item.checkState() == Qt.Checked
+        jobs = [
+            self.queueLabelJob(filename, flags)
+            for filename in list(MainWindow.queue_label.keys())
+            if filename is not None
+        ]
+        # The files are written in the background; the thumbnail of the
+        # current image is shown again once its label file is written.
+        # Only the journal records made until now are in these writes.
+        mark = (self.journal, 0 if self.journal is None else self.journal.lastSeq())
+        for job in jobs:
+            self._label_write_marks[job.image_filename].append(mark)
+        self.labelWriter.submit(jobs)
+
         corruption_layout = self.corruption_dock.widget().layout()
         if hasattr(self, 'canvas_label') and self.canvas_label:
             corruption_layout.removeWidget(self.canvas_label)
             self.canvas_label.deleteLater()
             self.canvas_label = None
-        if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(label_file):
-            original_pixmap = self.canvas.grab()
-            scaled_pixmap = original_pixmap.scaled(
-                original_pixmap.width() // 3,
-                original_pixmap.height() // 3,
-                QtCore.Qt.KeepAspectRatio,
-                QtCore.Qt.SmoothTransformation
-            )
-            label = QtWidgets.QLabel()
-            label.setPixmap(scaled_pixmap)
-            patch_height_index = corruption_layout.indexOf(self.patchHeightInput)
-            corruption_layout.insertWidget(patch_height_index + 1, label)
-            self.canvas_label = label
+
+    def showCanvasThumbnail(self):
+        corruption_layout = self.corruption_dock.widget().layout()
+        if hasattr(self, 'canvas_label') and self.canvas_label:
+            corruption_layout.removeWidget(self.canvas_label)
+            self.canvas_label.deleteLater()
+            self.canvas_label = None
+        original_pixmap = self.canvas.grab()
+        scaled_pixmap = original_pixmap.scaled(
+            original_pixmap.width() // 3,
+            original_pixmap.height() // 3,
+            QtCore.Qt.KeepAspectRatio,
+            QtCore.Qt.SmoothTransformation
+        )
+        label = QtWidgets.QLabel()
+        label.setPixmap(scaled_pixmap)
+        patch_height_index = corruption_layout.indexOf(self.patchHeightInput)
+        corruption_layout.insertWidget(patch_height_index + 1, label)
+        self.canvas_label = label
 
     def closeFile(self, _value=False):
         if not self.mayContinue():
@@ -2497,8 +2607,7 @@ class MainWindow(QtWidgets.QMainWindow):
             os.remove(label_file)
             logger.info("Label file is removed: {}".format(label_file))
 
-            item = self.fileListWidget.currentItem()
-            item.setCheckState(Qt.Unchecked)
+            self.fileListModel.setChecked(self.filename, False)
 
             self.resetState()
 
@@ -2615,11 +2724,7 @@ class MainWindow(QtWidgets.QMainWindow):
 
     @property
     def imageList(self):
-        lst = []
-        for i in range(self.fileListWidget.count()):
-            item = self.fileListWidget.item(i)
-            lst.append(item.text())
-        return lst
+        return self.fileListModel.filenames()
 
     def importDroppedImageFiles(self, imageFiles):
         extensions = [
@@ -2629,19 +2734,11 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.filename = None
         for file in imageFiles:
-            if file in self.imageList or not file.lower().endswith(tuple(extensions)):
+            if self.fileListModel.findRow(file) >= 0 or not file.lower().endswith(
+                tuple(extensions)
+            ):
                 continue
-            label_file = osp.splitext(file)[0] + ".json"
-            if self.output_dir:
-                label_file_without_path = osp.basename(label_file)
-                label_file = osp.join(self.output_dir, label_file_without_path)
-            item = QtWidgets.QListWidgetItem(file)
-            item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-            if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(label_file):
-                item.setCheckState(Qt.Checked)
-            else:
-                item.setCheckState(Qt.Unchecked)
-            self.fileListWidget.addItem(item)
+            self.fileListModel.appendFilename(file)
 
         if len(self.imageList) > 1:
             self.actions.openNextImg.setEnabled(True)
@@ -2658,28 +2755,147 @@ class MainWindow(QtWidgets.QMainWindow):
 
         self.lastOpenDir = dirpath
         self.filename = None
-        self.fileListWidget.clear()
+        self.openJournal(dirpath)
 
-        filenames = self.scanAllImages(dirpath)
-        if pattern:
+        extensions = [
+            ".%s" % fmt.data().decode().lower()
+            for fmt in QtGui.QImageReader.supportedImageFormats()
+        ]
+        index = DirectoryIndex(dirpath, extensions)
+        entries = index.load()
+        if entries is None:
+            entries, _ = index.scan()
             try:
-                filenames = [f for f in filenames if re.search(pattern, f)]
-            except re.error:
-                pass
-        for filename in filenames:
-            label_file = osp.splitext(filename)[0] + ".json"
-            if self.output_dir:
-                label_file_without_path = osp.basename(label_file)
-                label_file = osp.join(self.output_dir, label_file_without_path)
-            item = QtWidgets.QListWidgetItem(filename)
-            item.setFlags(Qt.ItemIsEnabled | Qt.ItemIsSelectable)
-            if QtCore.QFile.exists(label_file) and LabelFile.is_label_file(label_file):
-                item.setCheckState(Qt.Checked)
-            else:
-                item.setCheckState(Qt.Unchecked)
-            self.fileListWidget.addItem(item)
+                index.save()
+            except OSError as e:
+                logger.warning("Cannot save the index of %s: %s", dirpath, e)
+        else:
+            self.dirIndexer.revalidate(index)
+        self.setDirEntries(entries)
+        self.populateFileList(pattern)
         self.openNextImg(load=load)
 
+    def setDirEntries(self, entries):
+        """Use the [filename, has_label] entries of a directory index.
+
+        The index knows which images have a label file next to them; with
+        an output directory, it is scanned in the background instead.
+        """
+        self._dir_filenames = [filename for filename, _ in entries]
+        if self.output_dir:
+            self.labelStatus.reset(output_dir=self.output_dir)
+            self.labelStatus.scan(self._dir_filenames)
+        else:
+            self.labelStatus.reset(dict(entries))
+
+    def scanLabelStatus(self):
+        """Check again which listed images are labeled."""
+        self.labelStatus.reset(output_dir=self.output_dir)
+        self.labelStatus.scan(self.imageList)
+
+    def populateFileList(self, pattern=None):
+        """Fill the file list with the scanned images matching pattern."""
+        filenames = self._dir_filenames
+        match = filename_matcher(pattern)
+        if match is not None:
+            filenames = [f for f in filenames if match(f)]
+        self.fileListModel.setFilenames(filenames)
+
+    def onDirIndexScanned(self, dirpath, entries):
+        if dirpath != self.lastOpenDir:
+            return
+        self.setDirEntries(entries)
+        self.populateFileList(self.fileSearch.text())
+        row = self.fileListModel.findRow(self.filename)
+        if row >= 0:
+            self.fileListWidget.setCurrentRow(row, notify=False)
+
+    def openJournal(self, dirpath):
+        """Start journaling the edits made in dirpath.
+
+        Edits left in its journal by a previous session that did not
+        exit cleanly are written to the label files first.
+        """
+        path = edit_journal.journal_path(dirpath)
+        if self.journal is not None and self.journal.path == path:
+            return
+        self.closeJournal()
+        try:
+            self.journal = EditJournal(path)
+        except OSError as e:
+            logger.warning("Cannot journal edits in %s: %s", dirpath, e)
+            return
+        if self.journal.records():
+            saved, failed = self.compactJournal()
+            self.status(
+                str(self.tr("Recovered unsaved edits of %d images")) % saved
+            )
+            if failed:
+                self.errorMessage(
+                    self.tr("Error saving label data"),
+                    str(self.tr("Failed to recover the edits of %d images")) % failed,
+                )
+
+    def closeJournal(self):
+        if self.journal is None:
+            return
+        self.compactJournal()
+        self.journal.close()
+        self.journal = None
+
+    def compactJournal(self):
+        return self.journal.compact(
+            functools.partial(edit_journal.load_base, output_dir=self.output_dir),
+            functools.partial(
+                edit_journal.save_state,
+                patch_encoding=self._patch_encoding,
+                output_dir=self.output_dir,
+            ),
+        )
+
+    def syncJournal(self):
+        if self.journal is not None:
+            self.journal.sync()
+
+    def _journalGrid(self):
+        return (self.canvas.patch_width, self.canvas.patch_height)
+
+    def _journalSize(self):
+        return (self.image.height(), self.image.width())
+
+    def journalEdit(self, edit, merged):
+        if self.journal is None or not self.filename:
+            return
+        self.journal.append(
+            edit_journal.edit_record(
+                self.filename,
+                edit,
+                self.canvas.shapes,
+                self.formatShape,
+                self._journalGrid(),
+                self._journalSize(),
+                merge=merged,
+            )
+        )
+
+    def journalUndo(self):
+        if self.journal is None or not self.filename:
+            return
+        self.journal.append(edit_journal.undo_record(self.filename))
+
+    def journalSnapshot(self):
+        if self.journal is None or not self.filename:
+            return
+        self.journal.append(
+            edit_journal.snapshot_record(
+                self.filename,
+                [self.formatShape(s) for s in self.canvas.shapes],
+                self.canvas.mask_label.array,
+                self._journalGrid(),
+                self._journalSize(),
+            )
+        )
+
     def scanAllImages(self, folderPath):
         extensions = [
             ".%s" % fmt.data().decode().lower()
@@ -1,14 +1,25 @@
+import numpy as np
 import PIL.Image
-import PIL.ImageEnhance
-from qtpy import QtGui
+from qtpy import QtCore
 from qtpy import QtWidgets
 from qtpy.QtCore import Qt
 
-from .. import utils
+from .image_adjust import BrightnessContrast
 
 
 class BrightnessContrastDialog(QtWidgets.QDialog):
-    def __init__(self, img, callback, parent=None):
+    """Adjust brightness and contrast, passing each new image to callback.
+
+    While a value changes, previews are rendered at scale, the display
+    scale of the image, at most once per frame, and passed to callback at
+    that size. The full resolution image is rendered once the changes
+    stop, a slider is released or the dialog is closed.
+    """
+
+    FRAME_INTERVAL = 16  # ms
+    SETTLE_INTERVAL = 300  # ms
+
+    def __init__(self, img, callback, parent=None, scale=1.0):
         super(BrightnessContrastDialog, self).__init__(parent)
         self.setModal(True)
         self.setWindowTitle("Brightness/Contrast")
@@ -42,32 +53,69 @@ class BrightnessContrastDialog(QtWidgets.QDialog):
         formLayout.addRow(self.tr("Contrast"), contrast_layout)
         self.setLayout(formLayout)
 
-        assert isinstance(img, PIL.Image.Image)
-        self.img = img
+        # img is a PIL image, or the BrightnessContrast of an image.
+        if isinstance(img, BrightnessContrast):
+            self.img = None
+            self.adjuster = img
+        else:
+            assert isinstance(img, PIL.Image.Image)
+            self.img = img
+            self.adjuster = BrightnessContrast(np.asarray(img.convert("RGBA")))
         self.callback = callback
+        self.scale = scale
+        self._preview_shown = False
+
+        self._preview_timer = QtCore.QTimer(self)
+        self._preview_timer.setSingleShot(True)
+        self._preview_timer.setInterval(self.FRAME_INTERVAL)
+        self._preview_timer.timeout.connect(self.renderPreview)
+        self._settle_timer = QtCore.QTimer(self)
+        self._settle_timer.setSingleShot(True)
+        self._settle_timer.setInterval(self.SETTLE_INTERVAL)
+        self._settle_timer.timeout.connect(self.render)
+        self.finished.connect(self._onFinished)
+
+    def _factors(self):
+        return (
+            self.slider_brightness.value() / 50.0,
+            self.slider_contrast.value() / 50.0,
+        )
 
     def onNewValue(self, value):
-        brightness = self.slider_brightness.value() / 50.0
-        contrast = self.slider_contrast.value() / 50.0
+        if not self._preview_timer.isActive():
+            self._preview_timer.start()
+        self._settle_timer.start()
+
+    def renderPreview(self):
+        engine = self.adjuster.downsampled(self.scale)
+        if engine is self.adjuster:
+            self.render()
+            return
+        self._preview_shown = True
+        self.callback(engine.qimage(*self._factors()))
 
-        img = self.img
-        img = PIL.ImageEnhance.Brightness(img).enhance(brightness)
-        img = PIL.ImageEnhance.Contrast(img).enhance(contrast)
+    def render(self):
+        """Render the full resolution image now."""
+        self._preview_timer.stop()
+        self._settle_timer.stop()
+        self._preview_shown = False
+        self.callback(self.adjuster.qimage(*self._factors()))
 
-        img_data = utils.img_pil_to_data(img)
-        qimage = QtGui.QImage.fromData(img_data)
-        self.callback(qimage)
+    def _onFinished(self, result):
+        if self._preview_shown or self._settle_timer.isActive():
+            self.render()
 
     def _create_slider(self):
         slider = QtWidgets.QSlider(Qt.Horizontal)
         slider.setRange(0, 150)
         slider.setValue(50)
         slider.valueChanged.connect(self.onNewValue)
+        slider.sliderReleased.connect(self.render)
         return slider
         
     def _create_spinbox(self):
         spinbox = QtWidgets.QSpinBox()
         spinbox.setRange(0, 150)
         spinbox.setValue(50)
-        spinbox.valueChanged.connect(self.onNewValue)
+        # Its changes reach onNewValue through the slider it is wired to.
         return spinbox
@@ -1,3 +1,5 @@
+import concurrent.futures
+
 import imgviz
 from qtpy import QtCore
 from qtpy import QtGui
@@ -8,11 +10,22 @@ import labelme.utils
 from labelme import QT5
 from labelme.logger import logger
 from labelme.shape import Shape
-from qtpy.QtCore import Qt, QPoint
-from qtpy.QtGui import QPainter, QColor, QPen, QPixmap
-from labelme.utils.shape import shape_to_mask
-from collections import defaultdict
+from qtpy.QtCore import Qt
+from qtpy.QtGui import QPainter, QColor, QPen
+from collections import namedtuple
 import numpy as np
+
+from .ai_embedding import EmbeddingCache
+from .ai_embedding import embed_image
+from .patch_labels import label_value
+from .patch_labels import make_label
+from .patch_mask import CellSet
+from .patch_mask import PatchGrid
+from .patch_mask import PatchMask
+from .patch_overlay import PatchOverlay
+from .undo_stack import Edit
+from .undo_stack import ShapeState
+from .undo_stack import UndoStack
 # TODO(unknown):
 # - [maybe] Find optimal epsilon value.
 
@@ -25,6 +38,14 @@ CURSOR_GRAB = QtCore.Qt.OpenHandCursor
 
 MOVE_SPEED = 5.0
 
+# Extra widget pixels repainted around dirty regions, so that vertices
+# and pen widths drawn around the region are refreshed too.
+DIRTY_MARGIN = 12
+
+# Cells touched by a patch_annotation shape, and the label last written
+# into the mask for them. signature tells when the points have changed.
+PatchCells = namedtuple("PatchCells", ["signature", "label", "rows", "cols"])
+
 
 class Canvas(QtWidgets.QWidget):
     zoomRequest = QtCore.Signal(int, QtCore.QPoint)
@@ -39,6 +60,14 @@ class Canvas(QtWidgets.QWidget):
     reset_masklabel=QtCore.Signal()
     copy_masklabel=QtCore.Signal()
     paste_masklabel=QtCore.Signal()
+    # Emitted with each Edit pushed to the undo stack, and whether it was
+    # merged into the previous one.
+    edited = QtCore.Signal(object, bool)
+    undone = QtCore.Signal()
+    # The mask was rebuilt for another grid without an undoable edit.
+    maskReset = QtCore.Signal()
+    # Emitted from the worker thread when an AI embedding is computed.
+    aiImageEmbedded = QtCore.Signal()
 
     
     CREATE, EDIT = 0, 1
@@ -58,7 +87,17 @@ class Canvas(QtWidgets.QWidget):
             raise ValueError(
                 "Unexpected value for double_click event: {}".format(self.double_click)
             )
+        # num_backups is still accepted for old configs; the undo history
+        # is bounded by undo_memory_limit (bytes) instead.
         self.num_backups = kwargs.pop("num_backups", 10)
+        self.compact_patch_strokes = kwargs.pop("compact_patch_strokes", False)
+        self._ai_embeddings = EmbeddingCache(
+            max_entries=kwargs.pop("ai_embedding_cache_size", 16),
+            directory=kwargs.pop("ai_embedding_cache_dir", None),
+        )
+        self.undoStack = UndoStack(
+            kwargs.pop("undo_memory_limit", 64 * 1024 * 1024)
+        )
         self._crosshair = kwargs.pop(
             "crosshair",
             {
@@ -76,7 +115,17 @@ class Canvas(QtWidgets.QWidget):
         # Initialise local state.
         self.mode = self.EDIT
         self.shapes = []
-        self.shapesBackups = []
+        # Last state pushed to the undo stack, that the next edit is
+        # compared against.
+        self._committed_shapes = None
+        self._committed_states = None
+        self._committed_mask = None
+        # What was written since the last commit, so that storeShapes only
+        # compares these: (rows, cols) of the mask cells, whether the whole
+        # mask was replaced, and the shapes that may have been modified.
+        self._touched_cells = []
+        self._mask_replaced = False
+        self._touched_shapes = set()
         self.current = None
         self.selectedShapes = []  # save the selected shapes here
         self.selectedShapesCopy = []
@@ -91,6 +140,8 @@ class Canvas(QtWidgets.QWidget):
         self.offsets = QtCore.QPoint(), QtCore.QPoint()
         self.scale = 1.0
         self.pixmap = QtGui.QPixmap()
+        # Smaller image drawn over the whole pixmap, see setDisplayPixmap.
+        self._preview_pixmap = None
         self.visible = {}
         self._hideBackround = False
         self.hideBackround = False
@@ -114,10 +165,21 @@ class Canvas(QtWidgets.QWidget):
         self.setFocusPolicy(QtCore.Qt.WheelFocus)
 
         self._ai_model = None
+        # Embeddings are computed in a worker; _ai_embedding is the Future
+        # of the last one, and AI clicks are ignored until it is done.
+        self._ai_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._ai_embedding = None
+        self.aiImageEmbedded.connect(self._onAiImageEmbedded)
 
         self.patch_width = 16
         self.patch_height = 16
-        self.previous_masks = {}
+        self._overlay = PatchOverlay()
+        self.mask_label = self.initialize_mask(self.patch_width, self.patch_height)
+        self._patch_grid = None
+        self._grid_layer = None
+        self.patch_cells = {}  # key=shape, value=PatchCells
+        self._stroke_cells = None
+        self._stroke_pos = None
         self.shapes_visible = True
         self.class_text = None
         self.intensity_text = None
@@ -130,6 +192,16 @@ class Canvas(QtWidgets.QWidget):
     def setFillDrawing(self, value):
         self._fill_drawing = value
 
+    @property
+    def mask_label(self):
+        return self._mask_label
+
+    @mask_label.setter
+    def mask_label(self, mask):
+        self._mask_label = mask
+        self._mask_replaced = True
+        self._overlay.invalidate()
+
     @property
     def createMode(self):
         return self._createMode
@@ -165,34 +237,142 @@ class Canvas(QtWidgets.QWidget):
             logger.warning("Pixmap is not set yet")
             return
 
-        self._ai_model.set_image(
-            image=labelme.utils.img_qt_to_arr(self.pixmap.toImage())
+        self.embedAiImage()
+
+    def embedAiImage(self):
+        """Compute the embedding of the pixmap by the AI model in the background."""
+        if self._ai_model is None or self.pixmap is None:
+            return
+        # QPixmap is only usable in the GUI thread, QImage in any.
+        image = self.pixmap.toImage()
+        model = self._ai_model
+        cache = self._ai_embeddings
+        self._ai_embedding = self._ai_executor.submit(
+            lambda: embed_image(model, labelme.utils.img_qt_to_arr(image), cache)
+        )
+        self._ai_embedding.add_done_callback(lambda f: self.aiImageEmbedded.emit())
+
+    def isAiImageReady(self):
+        future = self._ai_embedding
+        return (
+            self._ai_model is not None
+            and future is not None
+            and future.done()
+            and future.exception() is None
         )
 
-    def storeMaskLabel(self):
-        self.mask_label_backup = [row[:] for row in self.mask_label]
+    def _onAiImageEmbedded(self):
+        future = self._ai_embedding
+        if future is not None and future.done() and future.exception() is not None:
+            logger.error("Failed to embed the image: %s", future.exception())
+        self.update()
 
-    def restoreMaskLabel(self):
-        self.mask_label = [row[:] for row in self.mask_label_backup]
+    def _waitAiImage(self):
+        if self._ai_embedding is not None:
+            concurrent.futures.wait([self._ai_embedding])
 
-    def storeShapes(self):
-        shapesBackup = []
-        for shape in self.shapes:
-            shapesBackup.append(shape.copy())
-        if len(self.shapesBackups) > self.num_backups:
-            self.shapesBackups = self.shapesBackups[-self.num_backups - 1 :]
-        # self.shapesBackups.append(shapesBackup)
-        self.shapesBackups.append((shapesBackup, [row[:] for row in self.mask_label]))
-        self.storeMaskLabel()
+    def restoreMaskLabel(self):
+        if self._committed_mask is None:
+            self.mask_label = self.initialize_mask(self.patch_width, self.patch_height)
+        else:
+            self.mask_label = self._committed_mask.copy()
+
+    def _commitState(self):
+        self._committed_shapes = list(self.shapes)
+        self._committed_states = {s: ShapeState.of(s) for s in self.shapes}
+        self._committed_mask = self.mask_label.copy()
+        self._clearTouched()
+
+    def _clearTouched(self):
+        self._touched_cells = []
+        self._mask_replaced = False
+        self._touched_shapes = set()
+
+    def touchShape(self, shape):
+        """Note that shape may be modified in place, e.g. relabeled."""
+        self._touched_shapes.add(shape)
+
+    def _rebaseUndo(self):
+        """Drop the undo history and take the current state as its base."""
+        self.undoStack.clear()
+        self._commitState()
+
+    def storeShapes(self, merge=False):
+        """Push the changes made since the last call to the undo stack.
+
+        Only the difference is stored: changed mask cells and the shapes
+        that were added, removed or modified. With merge, the changes are
+        undone together with the previous edit. Returns whether anything
+        changed.
+        """
+        self.syncPatchCells()
+        if self._committed_mask is None or (
+            self._committed_mask.shape != self.mask_label.shape
+        ):
+            self._rebaseUndo()
+            return False
+        # The shapes being edited by the user are compared too.
+        touched = self._touched_shapes.union(self.selectedShapes)
+        if self.hShape is not None:
+            touched.add(self.hShape)
+        edit = Edit.diff(
+            self._committed_shapes,
+            self._committed_states,
+            self._committed_mask,
+            self.shapes,
+            self.mask_label,
+            cells=None if self._mask_replaced else self._touched_cells,
+            touched=touched,
+        )
+        self._clearTouched()
+        if edit.isEmpty():
+            return False
+        for rows, cols, _, new in edit.cells:
+            self._committed_mask.array[rows, cols] = new
+        for shape, _, new in edit.modified:
+            self._committed_states[shape] = new
+        for _, shape in edit.removed:
+            del self._committed_states[shape]
+        for _, shape in edit.added:
+            self._committed_states[shape] = ShapeState.of(shape)
+        self._committed_shapes = list(self.shapes)
+        if merge:
+            self.undoStack.merge(edit)
+        else:
+            self.undoStack.push(edit)
+        self.edited.emit(edit, merge)
+        return True
 
     @property
     def isShapeRestorable(self):
-        # We save the state AFTER each edit (not before) so for an
-        # edit to be undoable, we expect the CURRENT and the PREVIOUS state
-        # to be in the undo stack.
-        if len(self.shapesBackups) < 2:
-            return False
-        return True
+        return len(self.undoStack) > 0
+
+    def _revertLastEdit(self):
+        edit = self.undoStack.pop()
+        self.undone.emit()
+        self.shapes = edit.revert(self.shapes, [self._mask_label, self._committed_mask])
+        rows, cols = edit.changedCells()
+        self._overlay.update(self.mask_label, rows, cols)
+        self._committed_shapes = list(self.shapes)
+        current = set(self.shapes)
+        for shape in edit.shapes():
+            if shape in current:
+                self._committed_states[shape] = ShapeState.of(shape)
+            else:
+                self._committed_states.pop(shape, None)
+        self._clearTouched()
+        # The mask already holds the labels of the restored shapes.
+        if self.pixmap:
+            grid = self.patchGrid()
+            for shape in edit.shapes():
+                if shape not in self._committed_states:
+                    self.patch_cells.pop(shape, None)
+                elif self._isPatchShape(shape) and shape.points:
+                    rows, cols = self._patchShapeCells(shape, grid)
+                    self.patch_cells[shape] = PatchCells(
+                        self._patchSignature(shape), shape.label, rows, cols
+                    )
+        return edit
 
     def restoreShape(self):
         # This does _part_ of the job of restoring shapes.
@@ -200,14 +380,7 @@ class Canvas(QtWidgets.QWidget):
         # and app.py::loadShapes and our own Canvas::loadShapes function.
         if not self.isShapeRestorable:
             return
-        self.shapesBackups.pop()  # latest
-
-        # The application will eventually call Canvas.loadShapes which will
-        # push this right back onto the stack.
-        # shapesBackup = self.shapesBackups.pop()
-        shapesBackup, mask_label_backup = self.shapesBackups.pop()
-        self.shapes = shapesBackup
-        self.mask_label = mask_label_backup
+        self._revertLastEdit()
         self.selectedShapes = []
         for shape in self.shapes:
             shape.selected = False
@@ -245,7 +418,7 @@ class Canvas(QtWidgets.QWidget):
     def unHighlight(self):
         if self.hShape:
             self.hShape.highlightClear()
-            #self.update()
+            self.updateShapeRects(self.hShape)
         self.prevhShape = self.hShape
         self.prevhVertex = self.hVertex
         self.prevhEdge = self.hEdge
@@ -275,10 +448,15 @@ class Canvas(QtWidgets.QWidget):
         # Box annotation mode with Shift+RightClick drag
         if self.box_annotation_mode and self.box_start_point is not None:
             self.overrideCursor(CURSOR_DRAW)
+            dirty = QtCore.QRectF(self.line.points[0], self.line.points[-1])
             self.line.shape_type = "rectangle"
             self.line.points = [self.box_start_point, pos]
             self.line.point_labels = [1, 1]
-            self.update()
+            self.updateImageRect(
+                dirty.normalized().united(
+                    QtCore.QRectF(self.box_start_point, pos).normalized()
+                )
+            )
             return
 
         if self.drawing() and self.createMode == "patch_annotation" and is_shift_pressed:
@@ -290,8 +468,7 @@ class Canvas(QtWidgets.QWidget):
             if self.outOfPixmap(pos):
                 pos = self.intersectionPoint(self.current[-1], pos)
 
-            self.current.addPoint(pos)
-            #self.repaint()
+            self._addStrokePoint(pos)
             return
         
         # Polygon drawing.
@@ -349,7 +526,7 @@ class Canvas(QtWidgets.QWidget):
                 self.line.point_labels = [1]
                 self.line.close()
             elif self.createMode == "patch_annotation" and is_shift_pressed:
-                self.current.addPoint(pos, label=1)  # Add points while dragging
+                self._addStrokePoint(pos)  # Add points while dragging
                 #self.update()
 
                 
@@ -387,6 +564,7 @@ class Canvas(QtWidgets.QWidget):
         # - Highlight vertex
         # Update shape/vertex fill and tooltip value accordingly.
         self.setToolTip(self.tr("Image"))
+        previous = self.hShape
         for shape in reversed([s for s in self.shapes if self.isVisible(s)]):
             # Look for a nearby vertex to highlight. If that fails,
             # check if we happen to be inside a shape.
@@ -403,7 +581,7 @@ class Canvas(QtWidgets.QWidget):
                 self.overrideCursor(CURSOR_POINT)
                 self.setToolTip(self.tr("Click & drag to move point"))
                 self.setStatusTip(self.toolTip())
-                self.update()
+                self.updateShapeRects(previous, shape)
                 break
             elif index_edge is not None and shape.canAddPoint():
                 if self.selectedVertex():
@@ -415,7 +593,7 @@ class Canvas(QtWidgets.QWidget):
                 self.overrideCursor(CURSOR_POINT)
                 self.setToolTip(self.tr("Click to create point"))
                 self.setStatusTip(self.toolTip())
-                self.update()
+                self.updateShapeRects(previous, shape)
                 break
             elif shape.containsPoint(pos):
                 if self.selectedVertex():
@@ -430,7 +608,7 @@ class Canvas(QtWidgets.QWidget):
                 )
                 self.setStatusTip(self.toolTip())
                 self.overrideCursor(CURSOR_GRAB)
-                self.update()
+                self.updateShapeRects(previous, shape)
                 break
         else:  # Nothing found, clear highlights, reset state.
             self.unHighlight()
@@ -443,6 +621,8 @@ class Canvas(QtWidgets.QWidget):
         if shape is None or index is None or point is None:
             return
         shape.insertPoint(index, point)
+        self.touchShape(shape)
+        self.patch_cells.pop(shape, None)
         shape.highlightVertex(index, shape.MOVE_VERTEX)
         self.hShape = shape
         self.hVertex = index
@@ -455,6 +635,8 @@ class Canvas(QtWidgets.QWidget):
         if shape is None or index is None:
             return
         shape.removePoint(index)
+        self.touchShape(shape)
+        self.patch_cells.pop(shape, None)
         shape.highlightClear()
         self.hShape = shape
         self.prevhVertex = None
@@ -480,6 +662,13 @@ class Canvas(QtWidgets.QWidget):
             return
         
         if ev.button() == QtCore.Qt.LeftButton:
+            if (
+                self.drawing()
+                and self.createMode in ["ai_polygon", "ai_mask"]
+                and not self.isAiImageReady()
+            ):
+                # The embedding of the image is still being computed.
+                return
             if self.drawing():
                 if self.current:
                     # Add point to existing shape.
@@ -507,7 +696,7 @@ class Canvas(QtWidgets.QWidget):
                         if ev.modifiers() & QtCore.Qt.ControlModifier:
                             self.finalise()
                     elif self.createMode == "patch_annotation" and is_shift_pressed:
-                        self.current.addPoint(self.line[1])
+                        self._addStrokePoint(self.line[1])
                         self.line[0] = self.current[-1]
 
                 elif not self.outOfPixmap(pos):
@@ -521,6 +710,7 @@ class Canvas(QtWidgets.QWidget):
                     if self.createMode == "point":
                         self.finalise()
                     if self.createMode =="patch_annotation":
+                        self._beginStrokeCells(pos)
                         if is_shift_pressed:
                             self.line.points = [pos, pos]
                             self.line.point_labels = [1, 1]
@@ -579,6 +769,11 @@ class Canvas(QtWidgets.QWidget):
         self.patch_width = patch_width
         self.patch_height = patch_height
         self.mask_label = self.initialize_mask(self.patch_width, self.patch_height)
+        self.patch_cells = {}
+        self.syncPatchCells()
+        # The recorded cells refer to the old grid.
+        self._rebaseUndo()
+        self.maskReset.emit()
         self.update()
 
     def drawGridOnPixmap(self):
@@ -587,19 +782,37 @@ class Canvas(QtWidgets.QWidget):
 
         painter = QPainter(self.pixmap)
         pen = QPen(QColor(0, 255, 0), 3, Qt.SolidLine) 
-        painter.setPen(pen)
+        path, _ = self.gridLayer()
+        painter.strokePath(path, pen)
+        painter.end()
+
+    def gridLayer(self):
+        """Return the (path, pen) of the patch grid lines.
 
+        The path is built once and reused until the patch size, the pixmap
+        size or the grid opacity changes; it is in image coordinates, so
+        zooming reuses it.
+        """
         width = self.pixmap.width()
         height = self.pixmap.height()
+        alpha = 255 if self.shapes_visible else 76
+        key = (self.patch_width, self.patch_height, width, height, alpha)
+        if self._grid_layer is not None and self._grid_layer[0] == key:
+            return self._grid_layer[1:]
+
+        path = QtGui.QPainterPath()
         h_step = width // self.patch_width
         v_step = height // self.patch_height
-        # self.debug_trace()
         for i in range(1, self.patch_width):
-            painter.drawLine(QPoint(i * h_step, 0), QPoint(i * h_step, height))
+            path.moveTo(i * h_step, 0)
+            path.lineTo(i * h_step, height)
         for i in range(1, self.patch_height):
-            painter.drawLine(QPoint(0, i * v_step), QPoint(width, i * v_step))
-
-        painter.end()
+            path.moveTo(0, i * v_step)
+            path.lineTo(width, i * v_step)
+        pen = QtGui.QPen(QtGui.QColor(0, 255, 0, alpha))
+        pen.setWidth(3)
+        self._grid_layer = (key, path, pen)
+        return path, pen
 
     def mouseReleaseEvent(self, ev):
         # Handle box annotation mode release with Shift+RightClick
@@ -635,9 +848,7 @@ class Canvas(QtWidgets.QWidget):
                     )
 
         if self.movingShape and self.hShape:
-            index = self.shapes.index(self.hShape)
-            if self.shapesBackups[-1][index].points != self.shapes[index].points:
-                self.storeShapes()
+            if self.storeShapes():
                 self.shapeMoved.emit()
 
             self.movingShape = False
@@ -653,6 +864,7 @@ class Canvas(QtWidgets.QWidget):
         else:
             for i, shape in enumerate(self.selectedShapesCopy):
                 self.selectedShapes[i].points = shape.points
+                self.touchShape(self.selectedShapes[i])
         self.selectedShapesCopy = []
         #self.repaint()
         self.storeShapes()
@@ -676,9 +888,11 @@ class Canvas(QtWidgets.QWidget):
         if self.double_click != "close":
             return
 
-        if (
-            self.createMode == "polygon" and self.canCloseShape()
-        ) or self.createMode in ["ai_polygon", "ai_mask"]:
+        if (self.createMode == "polygon" and self.canCloseShape()) or (
+            self.createMode in ["ai_polygon", "ai_mask"]
+            and self.current
+            and self.isAiImageReady()
+        ):
             self.finalise()
 
     def selectShapes(self, shapes):
@@ -735,6 +949,8 @@ class Canvas(QtWidgets.QWidget):
         if self.outOfPixmap(pos):
             pos = self.intersectionPoint(point, pos)
         shape.moveVertexBy(index, pos - point)
+        self.touchShape(shape)
+        self.patch_cells.pop(shape, None)
 
     def boundedMoveShapes(self, shapes, pos):
         if self.outOfPixmap(pos):
@@ -757,6 +973,7 @@ class Canvas(QtWidgets.QWidget):
         if dp:
             for shape in shapes:
                 shape.moveBy(dp)
+                self.touchShape(shape)
             self.prevPoint = pos
             return True
         return False
@@ -804,22 +1021,215 @@ class Canvas(QtWidgets.QWidget):
         if not self.boundedMoveShapes(shapes, point - offset):
             self.boundedMoveShapes(shapes, point + offset)
     
-    def print_mask(self):
-        for row in self.mask_label:
-            print(' '.join(str(cell) for cell in row))
-
     def initialize_mask(self,width,height):
-        return [[[0, 0] for _ in range(width)] for _ in range(height)]
+        return PatchMask(width, height)
     
     def set_mask_label(self, i, j, label):
-        if label[0] == '0':
-            self.mask_label[i][j] = [0, 0]
-        elif label[0].isdigit():
-            first_digit = int(label[0])
-            second_digit = {'q': 1, 'w': 2, 'e': 3, 'r': 4}[label[1]]
-            # self.debug_trace()
-            self.mask_label[i][j] = [first_digit, second_digit]
-        
+        value = label_value(label)
+        if value is None:
+            return
+        self.set_mask_value(i, j, value)
+
+    def set_mask_value(self, i, j, value):
+        """Write value=(class, intensity) into the cells at (i, j).
+
+        i and j may be scalars, index arrays or slices; all the cells are
+        written with one array assignment.
+        """
+        self.mask_label.set(i, j, value)
+        self._touched_cells.append((i, j))
+        self._overlay.update(self.mask_label, i, j)
+        self.updateCells(i, j)
+
+    def patchGrid(self):
+        key = (
+            self.pixmap.width(),
+            self.pixmap.height(),
+            self.patch_width,
+            self.patch_height,
+        )
+        if self._patch_grid is None or self._patch_grid.key != key:
+            self._patch_grid = PatchGrid(*key)
+        return self._patch_grid
+
+    def _beginStrokeCells(self, pos):
+        self._stroke_cells = CellSet()
+        self._stroke_cells.add(self.patchGrid().cellAt(pos.x(), pos.y()))
+        self._stroke_pos = pos
+
+    def _extendStrokeCells(self, p1, p2):
+        """Walk the new stroke segment p1-p2 in cell space.
+
+        Returns the cells touched for the first time by the current stroke.
+        """
+        if self._stroke_cells is None:
+            return []
+        cells = self.patchGrid().segmentCells(p1.x(), p1.y(), p2.x(), p2.y())
+        return self._stroke_cells.update(cells)
+
+    def _resetStrokeCells(self):
+        self._stroke_cells = None
+        if not self.current or self.current.shape_type != "patch_annotation":
+            return
+        self._beginStrokeCells(self.current[0])
+        for p1, p2 in zip(self.current.points[:-1], self.current.points[1:]):
+            self._extendStrokeCells(p1, p2)
+        self._stroke_pos = self.current[-1]
+
+    def _addStrokePoint(self, pos):
+        """Extend the patch stroke being drawn to pos.
+
+        With compact_patch_strokes, a point is added only when the stroke
+        enters another cell, at the center of that cell, instead of one
+        point per mouse event. Consecutive cells of a walk share an edge,
+        so the points still rasterize to the cells the stroke touched.
+        """
+        if self._stroke_cells is None:
+            self._resetStrokeCells()
+        last = self._stroke_pos
+        self._stroke_pos = pos
+        if not self.compact_patch_strokes:
+            self._extendStrokeCells(last, pos)
+            self.updateImageRect(QtCore.QRectF(last, pos).normalized())
+            self.current.addPoint(pos)
+            return
+        grid = self.patchGrid()
+        cells = grid.segmentCells(last.x(), last.y(), pos.x(), pos.y())
+        self._stroke_cells.update(cells)
+        if len(cells) < 2:
+            return
+        for row, col in cells[1:]:
+            self.current.addPoint(QtCore.QPointF(*grid.cellCenter(row, col)))
+        rows, cols = zip(*cells)
+        self.updateCells(rows, cols)
+
+    def _patchSignature(self, shape):
+        # Moving a shape replaces its points list, while moving a single
+        # vertex edits it in place and drops the cache entry explicitly.
+        first, last = shape.points[0], shape.points[-1]
+        return (
+            id(shape.points),
+            len(shape.points),
+            first.x(),
+            first.y(),
+            last.x(),
+            last.y(),
+        )
+
+    def syncPatchCells(self):
+        """Write the cells of new or changed patch shapes into the mask.
+
+        Only shapes whose points or label changed since the last call are
+        rasterized and written, so the cost depends on the edited shapes,
+        not on the image size or the number of shapes.
+        """
+        if not self.pixmap:
+            return
+        grid = self.patchGrid()
+        patch_cells = {}
+        for shape in self.shapes:
+            if not self._isPatchShape(shape) or not shape.points:
+                continue
+            signature = self._patchSignature(shape)
+            entry = self.patch_cells.get(shape)
+            if entry is None or entry.signature != signature:
+                cells = self._loadedPatchCells(shape, grid) if entry is None else None
+                if cells is None:
+                    cells = self._patchShapeCells(shape, grid)
+                entry = PatchCells(signature, None, cells[0], cells[1])
+            if shape.label and entry.label != shape.label:
+                # The label is parsed once per shape, not per cell.
+                value = label_value(shape.label)
+                if value is not None and (
+                    isinstance(entry.rows, slice) or len(entry.rows)
+                ):
+                    self.set_mask_value(entry.rows, entry.cols, value)
+                entry = entry._replace(label=shape.label)
+            patch_cells[shape] = entry
+        self.patch_cells = patch_cells
+
+    def _isPatchBox(self, shape):
+        """Return whether shape is a box of patches, see annotateWithBox.
+
+        Boxes are rectangles with a patch label; older label files store
+        them as 4-point patch strokes flagged in other_data.
+        """
+        if shape.shape_type == "rectangle":
+            return len(shape.points) == 2 and label_value(shape.label) is not None
+        return (
+            shape.shape_type == "patch_annotation"
+            and shape.other_data.get("patch_box", False)
+            and len(shape.points) == 4
+        )
+
+    def _isPatchShape(self, shape):
+        return shape.shape_type == "patch_annotation" or self._isPatchBox(shape)
+
+    def _patchShapeCells(self, shape, grid):
+        """Return the (rows, cols) covered by a patch shape.
+
+        A box covers the whole cell range of its bounding rectangle and is
+        returned as a pair of slices; a stroke covers the cells its
+        segments cross.
+        """
+        if self._isPatchBox(shape):
+            xs = [p.x() for p in shape.points]
+            ys = [p.y() for p in shape.points]
+            return grid.boxCells(min(xs), min(ys), max(xs), max(ys))
+        return grid.strokeCells([(p.x(), p.y()) for p in shape.points])
+
+    def _loadedPatchCells(self, shape, grid):
+        """Return the (rows, cols) saved with a loaded shape, if any.
+
+        They are only used once, and only if they were saved for the same
+        grid and all lie in it; otherwise the shape's points are rasterized.
+        """
+        cells = shape.other_data.pop("patch_cells", None)
+        size = shape.other_data.pop("patch_grid", None)
+        if cells is None or list(size or []) != [grid.cols, grid.rows]:
+            return None
+        try:
+            cells = np.asarray(cells, dtype=np.intp).reshape(-1, 2)
+        except (TypeError, ValueError):
+            logger.warning("Ignoring malformed patch_cells of %r", shape.label)
+            return None
+        rows, cols = cells[:, 0], cells[:, 1]
+        if not (
+            (0 <= rows).all()
+            and (rows < self.patch_height).all()
+            and (0 <= cols).all()
+            and (cols < self.patch_width).all()
+        ):
+            logger.warning(
+                "Ignoring patch_cells of %r out of the %dx%d grid",
+                shape.label,
+                self.patch_width,
+                self.patch_height,
+            )
+            return None
+        return rows, cols
+
+    def patchCellsData(self, shape):
+        """Return the JSON fields storing the cells of a patch shape.
+
+        The cells are saved in the order they were touched along with the
+        grid size, so loading the file with the same grid does not need
+        to rasterize the stroke again. Older files without them still
+        load from the points.
+        """
+        entry = self.patch_cells.get(shape)
+        if (
+            not self.compact_patch_strokes
+            or self._isPatchBox(shape)
+            or entry is None
+            or entry.signature != self._patchSignature(shape)
+        ):
+            return {}
+        return dict(
+            patch_cells=np.stack([entry.rows, entry.cols], axis=1).tolist(),
+            patch_grid=[self.patch_width, self.patch_height],
+        )
+
     # def set_mask_label(self, i, j, label):
     #     if label[0] == '0':
     #         self.mask_label[i][j] = [0, 0]
@@ -851,7 +1261,27 @@ class Canvas(QtWidgets.QWidget):
         p.scale(self.scale, self.scale)
         p.translate(self.offsetToCenter())
 
-        p.drawPixmap(0, 0, self.pixmap)
+        # Only the dirty region is repainted; skip whatever lies outside of
+        # it. margin covers pens and vertices of shapes crossing the border.
+        margin = DIRTY_MARGIN / self.scale
+        clip = self.widgetRectToImage(event.rect())
+        shape_clip = clip.adjusted(-margin, -margin, margin, margin)
+        source = clip.toAlignedRect().intersected(self.pixmap.rect())
+        if not source.isEmpty() and self._preview_pixmap is not None:
+            sx = self._preview_pixmap.width() / self.pixmap.width()
+            sy = self._preview_pixmap.height() / self.pixmap.height()
+            p.drawPixmap(
+                QtCore.QRectF(source),
+                self._preview_pixmap,
+                QtCore.QRectF(
+                    source.x() * sx,
+                    source.y() * sy,
+                    source.width() * sx,
+                    source.height() * sy,
+                ),
+            )
+        elif not source.isEmpty():
+            p.drawPixmap(source, self.pixmap, source)
 
         # draw crosshair
         if (
@@ -874,81 +1304,32 @@ class Canvas(QtWidgets.QWidget):
                 self.height() - 1,
             )
 
-        if not self.shapes_visible:
-            pen = QtGui.QPen(QtGui.QColor(0, 255, 0, 76))
-        else:
-            pen = QtGui.QPen(QtGui.QColor(0, 255, 0, 255))
-        pen.setWidth(3)
-        p.setPen(pen)
-        width = self.pixmap.width()
-        height = self.pixmap.height()
-        h_step = width // self.patch_width
-        v_step = height // self.patch_height
-        for i in range(1, self.patch_width):
-            p.drawLine(QPoint(i * h_step, 0), QPoint(i * h_step, height))
-        for i in range(1, self.patch_height):
-            p.drawLine(QPoint(0, i * v_step), QPoint(width, i * v_step))
+        # Grid lines are axis-aligned, so they are drawn without
+        # antialiasing in a single call.
+        path, pen = self.gridLayer()
+        p.setRenderHint(QtGui.QPainter.Antialiasing, False)
+        p.strokePath(path, pen)
+        p.setRenderHint(QtGui.QPainter.Antialiasing, True)
         
 
         Shape.scale = self.scale
         if self.shapes_visible:
-            for shape in self.shapes:
+            shapes = [s for s in self.shapes if self._shapeInRect(s, shape_clip)]
+            for shape in shapes:
                 if (shape.selected or not self._hideBackround) and self.isVisible(shape):
                     shape.fill = shape.selected or shape == self.hShape
-                    if shape.shape_type != "patch_annotation":
+                    if not self._isPatchShape(shape):
                         #점찍은 곳에 색깔 x
                         shape.paint(p)
 
             if (self.fillDrawing() and self.createMode == "patch_annotation"):
-                class_colors = {
-                    0: QtGui.QColor(0, 0, 0, 0),
-                    1: {1: QtGui.QColor(0, 255, 255, 90), 2: QtGui.QColor(0, 255, 255, 180)},
-                    2: {1: QtGui.QColor(255, 255, 0, 90), 2: QtGui.QColor(255, 255, 0, 180)}, 
-                    3: {1: QtGui.QColor(0, 0, 255, 90), 2: QtGui.QColor(0, 0, 255, 180)}, 
-                    4: {1: QtGui.QColor(0, 255, 0, 90), 2: QtGui.QColor(0, 255, 0, 180)}, 
-                    5: {1: QtGui.QColor(255, 0, 255, 90), 2: QtGui.QColor(255, 0, 255, 180)}, 
-                    6: {1: QtGui.QColor(255, 0, 0, 90), 2: QtGui.QColor(255, 0, 0, 180)}, 
-                }
-                for shape in self.shapes:
+                for shape in shapes:
                     if (shape.selected or not self._hideBackround) and self.isVisible(shape):
                         shape.fill = shape.selected or shape == self.hShape
                         shape.paint(p)
 
-                        if shape.shape_type == "patch_annotation":
-                            mask = shape_to_mask(
-                                (self.pixmap.height(), self.pixmap.width()), shape.points,
-                                shape_type="patch_annotation", patch_width=self.patch_width,
-                                patch_height=self.patch_height
-                            )
-                            patch_size_h = self.pixmap.height() // self.patch_height
-                            patch_size_w = self.pixmap.width() // self.patch_width
-                            previous_mask = self.previous_masks.get(shape)
-
-                            if previous_mask is None or not np.array_equal(mask, previous_mask):
-                                self.previous_masks[shape] = mask
-                                if mask.sum() != 0 and shape.label:
-                                    indices = np.argwhere(mask)
-                                    for idx in indices:
-                                        self.set_mask_label(idx[0], idx[1], shape.label)
-
                 if self.shapes:
-                    mask_label_array = np.array(self.mask_label)
-                    mask_nonzero_indices = np.argwhere(mask_label_array[:, :, 0] != 0)
-                    labels = mask_label_array[mask_nonzero_indices[:, 0], mask_nonzero_indices[:, 1]]
-
-                    for (i, j), label in zip(mask_nonzero_indices, labels):
-                        first_digit = label[0]
-                        second_digit = label[1]
-
-                        if first_digit == 0:
-                            color = class_colors[first_digit]
-                        else:
-                            color = class_colors[first_digit][second_digit]
-
-                        p.fillRect(j * patch_size_w, i * patch_size_h, patch_size_w, patch_size_h, color)
-
-                    #self.print_mask()
-                    #print('\n')
+                    self._overlay.paint(p, self.mask_label, self.patchGrid(), clip)
 
         if self.current:
             self.current.paint(p)
@@ -974,7 +1355,11 @@ class Canvas(QtWidgets.QWidget):
             drawing_shape.addPoint(self.line[1])
             drawing_shape.fill = True
             drawing_shape.paint(p)
-        elif self.createMode == "ai_polygon" and self.current is not None:
+        elif (
+            self.createMode == "ai_polygon"
+            and self.current is not None
+            and self.isAiImageReady()
+        ):
             drawing_shape = self.current.copy()
             drawing_shape.addPoint(
                 point=self.line.points[1],
@@ -993,7 +1378,11 @@ class Canvas(QtWidgets.QWidget):
                 drawing_shape.fill = self.fillDrawing()
                 drawing_shape.selected = True
                 drawing_shape.paint(p)
-        elif self.createMode == "ai_mask" and self.current is not None:
+        elif (
+            self.createMode == "ai_mask"
+            and self.current is not None
+            and self.isAiImageReady()
+        ):
             drawing_shape = self.current.copy()
             drawing_shape.addPoint(
                 point=self.line.points[1],
@@ -1019,6 +1408,78 @@ class Canvas(QtWidgets.QWidget):
         """Convert from widget-logical coordinates to painter-logical ones."""
         return point / self.scale - self.offsetToCenter()
 
+    def imageRectToWidget(self, rect, margin=DIRTY_MARGIN):
+        """Convert an image-space QRectF to an integer widget rect."""
+        offset = self.offsetToCenter()
+        s = self.scale
+        return (
+            QtCore.QRectF(
+                (rect.x() + offset.x()) * s,
+                (rect.y() + offset.y()) * s,
+                rect.width() * s,
+                rect.height() * s,
+            )
+            .adjusted(-margin, -margin, margin, margin)
+            .toAlignedRect()
+        )
+
+    def widgetRectToImage(self, rect):
+        offset = self.offsetToCenter()
+        s = self.scale
+        return QtCore.QRectF(
+            rect.x() / s - offset.x(),
+            rect.y() / s - offset.y(),
+            rect.width() / s,
+            rect.height() / s,
+        )
+
+    def updateImageRect(self, rect):
+        """Schedule a repaint of the image-space rect only."""
+        if not self.pixmap or self._crosshair.get(self._createMode):
+            # The crosshair spans the whole widget.
+            self.update()
+            return
+        self.update(self.imageRectToWidget(rect))
+
+    def updateShapeRects(self, *shapes):
+        rect = QtCore.QRectF()
+        for shape in shapes:
+            if shape is not None and shape.points:
+                rect = rect.united(shape.boundingRect())
+        if not rect.isNull():
+            self.updateImageRect(rect)
+
+    def updateCells(self, rows, cols):
+        """Schedule a repaint of the cells at (rows, cols).
+
+        rows and cols may be index arrays or slices.
+        """
+        if not self.pixmap:
+            return
+        grid = self.patchGrid()
+        if isinstance(rows, slice):
+            top, bottom = rows.start, rows.stop - 1
+            left, right = cols.start, cols.stop - 1
+        else:
+            rows, cols = np.asarray(rows), np.asarray(cols)
+            if not rows.size:
+                return
+            top, bottom = rows.min(), rows.max()
+            left, right = cols.min(), cols.max()
+        self.updateImageRect(
+            QtCore.QRectF(
+                left * grid.cell_width,
+                top * grid.cell_height,
+                (right - left + 1) * grid.cell_width,
+                (bottom - top + 1) * grid.cell_height,
+            )
+        )
+
+    def _shapeInRect(self, shape, rect):
+        if not shape.points:
+            return True
+        return shape.boundingRect().intersects(rect)
+
     def offsetToCenter(self):
         s = self.scale
         area = super(Canvas, self).size()
@@ -1037,6 +1498,7 @@ class Canvas(QtWidgets.QWidget):
         if self.createMode == "ai_polygon":
             # convert points to polygon by an AI model
             assert self.current.shape_type == "points"
+            self._waitAiImage()
             points = self._ai_model.predict_polygon_from_points(
                 points=[[point.x(), point.y()] for point in self.current.points],
                 point_labels=self.current.point_labels,
@@ -1049,6 +1511,7 @@ class Canvas(QtWidgets.QWidget):
         elif self.createMode == "ai_mask":
             # convert points to mask by an AI model
             assert self.current.shape_type == "points"
+            self._waitAiImage()
             mask = self._ai_model.predict_mask_from_points(
                 points=[[point.x(), point.y()] for point in self.current.points],
                 point_labels=self.current.point_labels,
@@ -1062,6 +1525,13 @@ class Canvas(QtWidgets.QWidget):
             )
         if self.createMode =="patch_annotation":
             self.current.close()
+            if self._stroke_cells is not None:
+                # The stroke was rasterized while drawing it.
+                rows, cols = self._stroke_cells.arrays()
+                self.patch_cells[self.current] = PatchCells(
+                    self._patchSignature(self.current), None, rows, cols
+                )
+                self._stroke_cells = None
             self.shapes.append(self.current)
             self.storeShapes()
             self.current = None
@@ -1196,13 +1666,13 @@ class Canvas(QtWidgets.QWidget):
             self.update()
         if ev.modifiers() & QtCore.Qt.ControlModifier:
             if ev.key() == QtCore.Qt.Key_C:
-                Canvas.temp_mask_data = [row[:] for row in self.mask_label]
+                Canvas.temp_mask_data = self.mask_label.copy()
                 # Canvas.temp_shape_data = self.shapes
                 self.copy_masklabel.emit()
 
             elif ev.key() == QtCore.Qt.Key_V:
                 if Canvas.temp_mask_data is not None:
-                    self.mask_label = [row[:] for row in Canvas.temp_mask_data]
+                    self.mask_label = Canvas.temp_mask_data.copy()
                     # self.shapes = Canvas.temp_shape_data
                     self.paste_masklabel.emit()
                     self.update()
@@ -1221,6 +1691,7 @@ class Canvas(QtWidgets.QWidget):
 
             if key == QtCore.Qt.Key_Escape and self.current:
                 self.current = None
+                self._stroke_cells = None
                 self.drawingPolygon.emit(False)
             elif key == QtCore.Qt.Key_Return and self.canCloseShape():
                 self.finalise()
@@ -1297,9 +1768,7 @@ class Canvas(QtWidgets.QWidget):
                 self.snapping = True
         elif self.editing():
             if self.movingShape and self.selectedShapes:
-                index = self.shapes.index(self.selectedShapes[0])
-                if self.shapesBackups[-1][index].points != self.shapes[index].points:
-                    self.storeShapes()
+                if self.storeShapes():
                     self.shapeMoved.emit()
 
                 self.movingShape = False
@@ -1308,13 +1777,19 @@ class Canvas(QtWidgets.QWidget):
         assert text
         self.shapes[-1].label = text
         self.shapes[-1].flags = flags
-        self.shapesBackups.pop()
-        self.storeShapes()
+        self.touchShape(self.shapes[-1])
+        self.storeShapes(merge=True)
         return self.shapes[-1]
 
     def undoLastLine(self):
         assert self.shapes
-        self.current = self.shapes.pop()
+        self.current = self.shapes[-1]
+        if self.isShapeRestorable:
+            # Drop the edit that added the shape, it is being drawn again.
+            self._revertLastEdit()
+        if self.current in self.shapes:
+            self.shapes.remove(self.current)
+            self._commitState()
         self.current.setOpen()
         self.current.restoreShapeRaw()
         if self.createMode in ["polygon", "linestrip"]:
@@ -1335,62 +1810,65 @@ class Canvas(QtWidgets.QWidget):
         else:
             self.current = None
             self.drawingPolygon.emit(False)
+        self._resetStrokeCells()
         self.restoreMaskLabel()
         self.update()
 
     def loadPixmap(self, pixmap, clear_shapes=True):
         # Store current mask_label before changing pixmap
-        old_mask_label = None
-        old_previous_masks = None
-        if hasattr(self, 'mask_label') and self.mask_label:
-            old_mask_label = [row[:] for row in self.mask_label]
-        if hasattr(self, 'previous_masks') and self.previous_masks:
-            old_previous_masks = dict(self.previous_masks)
+        old_mask_label = self.mask_label
             
         self.pixmap = pixmap
+        self._preview_pixmap = None
         
-        if self._ai_model:
-            self._ai_model.set_image(
-                image=labelme.utils.img_qt_to_arr(self.pixmap.toImage())
-            )
+        self.embedAiImage()
         if clear_shapes:
             self.shapes = []
             # Reset mask_label when shapes are cleared
             self.mask_label = self.initialize_mask(self.patch_width, self.patch_height)
-            self.previous_masks = {}  # Clear previous masks
+            self.patch_cells = {}
+            self._rebaseUndo()
         else:
             # Preserve mask_label when shapes are preserved (e.g., during brightness/contrast changes)
-            if old_mask_label and len(old_mask_label) == self.patch_height and len(old_mask_label[0]) == self.patch_width:
+            if old_mask_label.hasSize(self.patch_width, self.patch_height):
                 self.mask_label = old_mask_label
             else:
                 self.mask_label = self.initialize_mask(self.patch_width, self.patch_height)
                 
                 # If dimensions changed, reapply annotations from shapes to new mask_label
-                if self.shapes:
-                    for shape in self.shapes:
-                        if shape.shape_type == "patch_annotation" and shape.label:
-                            mask = shape_to_mask(
-                                (self.pixmap.height(), self.pixmap.width()), shape.points,
-                                shape_type="patch_annotation", patch_width=self.patch_width,
-                                patch_height=self.patch_height
-                            )
-                            if mask.sum() != 0:
-                                indices = np.argwhere(mask)
-                                for idx in indices:
-                                    self.set_mask_label(idx[0], idx[1], shape.label)
-            
-            # Preserve previous_masks if shapes are preserved
-            if old_previous_masks and not clear_shapes:
-                self.previous_masks = old_previous_masks
+                self.patch_cells = {}
+                self.syncPatchCells()
+                self._rebaseUndo()
+                self.maskReset.emit()
         
         self.update()
 
+    def setDisplayPixmap(self, pixmap):
+        """Replace the drawn image only, e.g. to show a brightness change.
+
+        Shapes, the patch mask, the undo history and the AI embedding are
+        left untouched; embedAiImage embeds the new pixmap if wanted. A
+        pixmap smaller than the image is a preview: it is stretched over
+        the image when painted, and the image itself is kept.
+        """
+        if self.pixmap and pixmap.size() != self.pixmap.size():
+            self._preview_pixmap = pixmap
+        else:
+            self.pixmap = pixmap
+            self._preview_pixmap = None
+        self.update()
+
     def loadShapes(self, shapes, replace=True):
         if replace:
             self.shapes = list(shapes)
         else:
             self.shapes.extend(shapes)
-        self.storeShapes()
+        if replace and not self.isShapeRestorable:
+            # Shapes loaded from a file are the base of the undo history.
+            self.syncPatchCells()
+            self._rebaseUndo()
+        else:
+            self.storeShapes()
         self.current = None
         self.hShape = None
         self.hVertex = None
@@ -1412,75 +1890,40 @@ class Canvas(QtWidgets.QWidget):
     def resetState(self):
         self.restoreCursor()
         self.pixmap = None
-        self.shapesBackups = []
+        self._preview_pixmap = None
+        self.undoStack.clear()
+        self._committed_shapes = None
+        self._committed_states = None
+        self._committed_mask = None
+        self._clearTouched()
         self.update()
 
     def get_mask_label(self):
-        return self.mask_label
+        return self.mask_label.tolist()
 
     def annotateWithBox(self, start_point, end_point):
         """Annotate patches that are inside or touch the box/line formed by the two points."""
         if not start_point or not end_point:
             return
             
-        # Create rectangle from the two points
-        x1, y1 = start_point.x(), start_point.y()
-        x2, y2 = end_point.x(), end_point.y()
-        
-        # In case the points are equal or form a line (no area)
-        if x1 == x2 or y1 == y2:
-            # Handle as a line annotation
-            shape = Shape(shape_type="patch_annotation")
-            if x1 == x2 and y1 == y2:
-                # Single point - just add the point
-                shape.addPoint(QtCore.QPointF(x1, y1))
-                shape.close()
-            else:
-                # Line - add points along the line
-                # Calculate the number of points to add based on the line length
-                if x1 == x2:  # Vertical line
-                    step = (y2 - y1) / max(abs(y2 - y1) / 5, 1)
-                    for y in np.arange(y1, y2 + step, step):
-                        shape.addPoint(QtCore.QPointF(x1, y))
-                else:  # Horizontal line
-                    step = (x2 - x1) / max(abs(x2 - x1) / 5, 1)
-                    for x in np.arange(x1, x2 + step, step):
-                        shape.addPoint(QtCore.QPointF(x, y1))
-                shape.close()
-        else:
-            # Create a full rectangle
-            # Normalize coordinates (in case of dragging from bottom to top or right to left)
-            x_min, x_max = min(x1, x2), max(x1, x2)
-            y_min, y_max = min(y1, y2), max(y1, y2)
-            
-            # Create a shape with points at the corners and inside the rectangle
-            shape = Shape(shape_type="patch_annotation")
-            
-            # Add points at corners and at regular intervals inside the rectangle
-            x_step = (x_max - x_min) / max(min(10, self.patch_width / 2), 1)
-            y_step = (y_max - y_min) / max(min(10, self.patch_height / 2), 1)
-            
-            for x in np.arange(x_min, x_max + x_step, x_step):
-                for y in np.arange(y_min, y_max + y_step, y_step):
-                    shape.addPoint(QtCore.QPointF(x, y))
-            
-            shape.close()
+        # Store the box as a rectangle of 2 corners; the cells it covers are
+        # computed from the grid boundaries (see _patchShapeCells), so a
+        # line or a single point is just a box one cell wide.
+        x_min, x_max = sorted((start_point.x(), end_point.x()))
+        y_min, y_max = sorted((start_point.y(), end_point.y()))
+        shape = Shape(shape_type="rectangle")
+        shape.addPoint(QtCore.QPointF(x_min, y_min))
+        shape.addPoint(QtCore.QPointF(x_max, y_max))
+        shape.close()
         
         # Apply current class/intensity if set
-        if hasattr(self, 'class_text') and hasattr(self, 'intensity_text') and self.class_text and self.intensity_text:
-            if self.class_text.startswith("class") and len(self.class_text) > 5:
-                class_digit = self.class_text[5]
-                
-                # Determine intensity character
-                intensity_char = 'q'  # Default to 'q' (BLURRY)
-                if self.intensity_text == "BLURRY":
-                    intensity_char = 'q'
-                elif self.intensity_text == "BLOCKAGE":
-                    intensity_char = 'w'
-                
-                # Only set label if it's a valid class
-                if class_digit.isdigit() and int(class_digit) > 0:
-                    shape.label = f"{class_digit}{intensity_char}"
+        if self.class_text and self.intensity_text and self.class_text != "CLEAN":
+            # Default to BLURRY unless BLOCKAGE is selected
+            intensity_text = "BLOCKAGE" if self.intensity_text == "BLOCKAGE" else "BLURRY"
+            label = make_label(self.class_text, intensity_text)
+            # Only set label if it's a valid class
+            if label_value(label) is not None:
+                shape.label = label
         
         # Add the shape to the list and store shapes
         self.shapes.append(shape)
@@ -0,0 +1,160 @@
+import concurrent.futures
+import hashlib
+import json
+import os
+import os.path as osp
+import re
+
+import natsort
+from qtpy import QtCore
+
+from labelme.logger import logger
+
+INDEX_VERSION = 1
+
+_REGEX_CHARS = frozenset(".^$*+?{}[]\\|()")
+
+
+def default_cache_dir():
+    return osp.join(osp.expanduser("~"), ".cache", "labelme", "dir_index")
+
+
+def filename_matcher(pattern):
+    """Return a predicate selecting the filenames matching pattern.
+
+    pattern is searched as a regex, or as a plain substring when it has no
+    regex characters. None is returned when nothing is to be filtered,
+    including for an invalid regex.
+    """
+    if not pattern:
+        return None
+    if _REGEX_CHARS.isdisjoint(pattern):
+        return lambda filename: pattern in filename
+    try:
+        return re.compile(pattern).search
+    except re.error:
+        return None
+
+
+class DirectoryIndex(object):
+    """Sorted image files of a directory tree, cached on disk.
+
+    For every directory, the index keeps its mtime, its subdirectories and
+    its image files along with whether a label file sits next to them.
+    Adding, removing or renaming an entry changes the mtime of its
+    directory, so revalidating the index only lists the directories whose
+    mtime changed; the others cost one stat each.
+    """
+
+    def __init__(self, dirpath, extensions, cache_dir=None):
+        self.dirpath = dirpath
+        self.extensions = tuple(sorted(set(extensions)))
+        key = "\0".join((osp.abspath(dirpath),) + self.extensions)
+        self.path = osp.join(
+            cache_dir or default_cache_dir(),
+            hashlib.sha1(key.encode("utf-8")).hexdigest() + ".json",
+        )
+        self._dirs = {}  # key=relative dir, value=dict(mtime, dirs, files)
+        self._entries = None  # sorted [filename, has_label]
+
+    def load(self):
+        """Return the cached entries, or None if there is no usable cache."""
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if data.get("version") != INDEX_VERSION:
+            return None
+        self._dirs = data["dirs"]
+        self._entries = data["entries"]
+        return self._entries
+
+    def save(self):
+        os.makedirs(osp.dirname(self.path), exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(
+                dict(version=INDEX_VERSION, dirs=self._dirs, entries=self._entries),
+                f,
+                separators=(",", ":"),
+            )
+        os.replace(tmp_path, self.path)
+
+    def _listDir(self, path, mtime):
+        dirs, images, names = [], [], set()
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    dirs.append(entry.name)
+                else:
+                    names.add(entry.name)
+                    if entry.name.lower().endswith(self.extensions):
+                        images.append(entry.name)
+        files = [[f, osp.splitext(f)[0] + ".json" in names] for f in images]
+        return dict(mtime=mtime, dirs=dirs, files=files)
+
+    def scan(self):
+        """Revalidate the index and return (entries, changed)."""
+        dirs = {}
+        changed = self._entries is None
+        stack = [""]
+        while stack:
+            rel = stack.pop()
+            path = osp.join(self.dirpath, rel)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+                cached = self._dirs.get(rel)
+                if cached is not None and cached["mtime"] == mtime:
+                    listing = cached
+                else:
+                    listing = self._listDir(path, mtime)
+                    changed = True
+            except OSError as e:
+                logger.warning("Cannot list %s: %s", path, e)
+                continue
+            dirs[rel] = listing
+            stack.extend(osp.join(rel, d) for d in listing["dirs"])
+        changed = changed or set(dirs) != set(self._dirs)
+        self._dirs = dirs
+        if changed:
+            entries = [
+                [osp.normpath(osp.join(self.dirpath, rel, f)), has_label]
+                for rel, listing in dirs.items()
+                for f, has_label in listing["files"]
+            ]
+            order = natsort.os_sort_keygen()
+            entries.sort(key=lambda entry: order(entry[0]))
+            self._entries = entries
+        return self._entries, changed
+
+
+class DirectoryIndexer(QtCore.QObject):
+    """Revalidate DirectoryIndexes in a worker thread.
+
+    scanned is emitted with the directory and its entries when the
+    revalidation found changes.
+    """
+
+    scanned = QtCore.Signal(str, object)
+
+    def __init__(self, parent=None):
+        super(DirectoryIndexer, self).__init__(parent)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def revalidate(self, index):
+        self._executor.submit(self._revalidate, index)
+
+    def _revalidate(self, index):
+        try:
+            entries, changed = index.scan()
+            if changed:
+                index.save()
+        except Exception as e:
+            logger.error("Failed to index %s: %s", index.dirpath, e)
+            return
+        if changed:
+            self.scanned.emit(index.dirpath, entries)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
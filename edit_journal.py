@@ -0,0 +1,332 @@
+import base64
+import collections
+import hashlib
+import json
+import os
+import os.path as osp
+
+import numpy as np
+
+from labelme.logger import logger
+
+from .image_prefetcher import label_file_path
+from .label_writer import save_atomic
+from .patch_codec import decode_patch
+from .patch_codec import encode_patch
+
+# Top-level keys of a label file written by save_state; the others are
+# otherData and are kept as they are.
+_LABEL_FILE_KEYS = frozenset(
+    [
+        "version",
+        "flags",
+        "shapes",
+        "patch",
+        "imagePath",
+        "imageData",
+        "imageHeight",
+        "imageWidth",
+    ]
+)
+
+
+def default_cache_dir():
+    return osp.join(osp.expanduser("~"), ".cache", "labelme", "journal")
+
+
+def journal_path(dirpath, cache_dir=None):
+    """Return the journal file of the images of dirpath.
+
+    Journals are kept in a per-user cache directory rather than next to
+    the images, so that writing them does not change the mtime of the
+    image directory.
+    """
+    key = osp.abspath(dirpath).encode("utf-8")
+    return osp.join(
+        cache_dir or default_cache_dir(), hashlib.sha1(key).hexdigest() + ".jsonl"
+    )
+
+
+def edit_record(image, edit, shapes, format_shape, grid, size, merge=False):
+    """Return the journal record of a canvas Edit made on image.
+
+    shapes is the shape list after the edit, grid the (patch_width,
+    patch_height) and size the (height, width) of the image. Cells are
+    stored as [row, col, old class, old intensity, new class, new
+    intensity] so that the record can also be undone. A reorder is
+    stored as the index in the kept shapes before the edit of each kept
+    shape after it.
+    """
+    cells = []
+    for rows, cols, old, new in edit.cells:
+        cells += np.column_stack([rows, cols, old, new]).tolist()
+    order = None
+    if edit.order is not None:
+        before = {id(s) for s in edit.order}
+        after = {id(s) for s in shapes}
+        kept_before = [s for s in edit.order if id(s) in after]
+        position = {id(s): i for i, s in enumerate(kept_before)}
+        order = [position[id(s)] for s in shapes if id(s) in before]
+    return dict(
+        t="edit",
+        image=image,
+        grid=list(grid),
+        size=list(size),
+        merge=merge,
+        cells=cells,
+        order=order,
+        removed=[[i, format_shape(s)] for i, s in edit.removed],
+        added=[[i, format_shape(s)] for i, s in edit.added],
+        modified=[
+            [
+                shapes.index(s),
+                [[p.x(), p.y()] for p in old.points],
+                old.label,
+                [[p.x(), p.y()] for p in new.points],
+                new.label,
+            ]
+            for s, old, new in edit.modified
+        ],
+    )
+
+
+def snapshot_record(image, shapes, mask, grid, size):
+    return dict(
+        t="snapshot",
+        image=image,
+        grid=list(grid),
+        size=list(size),
+        shapes=shapes,
+        patch=np.asarray(mask).tolist(),
+    )
+
+
+def undo_record(image):
+    return dict(t="undo", image=image)
+
+
+class ImageState(object):
+    """Shapes and patch mask of one image rebuilt from journal records."""
+
+    def __init__(self, shapes, mask, size):
+        self.shapes = shapes
+        self.mask = mask
+        self.size = size
+        self.history = []  # groups of edit records that can be undone
+
+    def _fitGrid(self, record):
+        cols, rows = record["grid"]
+        if self.mask is None or self.mask.shape[:2] != (rows, cols):
+            self.mask = np.zeros((rows, cols, 2), dtype=np.uint8)
+        self.size = record["size"]
+
+    def apply(self, record):
+        kind = record["t"]
+        if kind == "snapshot":
+            self._fitGrid(record)
+            self.shapes = list(record["shapes"])
+            self.mask = np.asarray(record["patch"], dtype=np.uint8)
+            self.history = []
+        elif kind == "edit":
+            self._fitGrid(record)
+            self._applyEdit(record)
+            if record["merge"] and self.history:
+                self.history[-1].append(record)
+            else:
+                self.history.append([record])
+        elif kind == "undo" and self.history:
+            for edit in reversed(self.history.pop()):
+                self._revertEdit(edit)
+
+    def _setCells(self, cells, start):
+        if cells:
+            cells = np.asarray(cells, dtype=np.intp)
+            self.mask[cells[:, 0], cells[:, 1]] = cells[:, start : start + 2]
+
+    def _applyEdit(self, record):
+        self._setCells(record["cells"], 4)
+        for index, _ in sorted(record["removed"], key=lambda x: -x[0]):
+            del self.shapes[index]
+        order = record.get("order")
+        if order is not None:
+            self.shapes = [self.shapes[i] for i in order]
+        for index, shape in sorted(record["added"], key=lambda x: x[0]):
+            self.shapes.insert(index, shape)
+        for index, _, _, points, label in record["modified"]:
+            self.shapes[index] = dict(self.shapes[index], points=points, label=label)
+
+    def _revertEdit(self, record):
+        self._setCells(record["cells"], 2)
+        for index, points, label, _, _ in record["modified"]:
+            self.shapes[index] = dict(self.shapes[index], points=points, label=label)
+        for index, _ in sorted(record["added"], key=lambda x: -x[0]):
+            del self.shapes[index]
+        order = record.get("order")
+        if order is not None:
+            shapes = list(self.shapes)
+            for shape, i in zip(shapes, order):
+                self.shapes[i] = shape
+        for index, shape in sorted(record["removed"], key=lambda x: x[0]):
+            self.shapes.insert(index, shape)
+
+
+class EditJournal(object):
+    """Append-only journal of the edits of the images of one directory.
+
+    Records are JSON lines, written as the edits happen. They are flushed
+    to the OS right away but only fsync'ed by sync(), which is meant to
+    be called periodically, or once sync_every records are pending. Each
+    record gets an increasing sequence number "seq"; lastSeq() marks the
+    point a saved state corresponds to, see discard().
+    """
+
+    def __init__(self, path, sync_every=32):
+        self.path = path
+        self.sync_every = sync_every
+        self._pending = 0
+        self._seq = max((r.get("seq", 0) for r in read_records(path)), default=0)
+        os.makedirs(osp.dirname(path), exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def append(self, record):
+        self._seq += 1
+        record = dict(record, seq=self._seq)
+        self._file.write(json.dumps(record, separators=(",", ":")) + "\n")
+        self._file.flush()
+        self._pending += 1
+        if self._pending >= self.sync_every:
+            self.sync()
+
+    def sync(self):
+        if self._pending:
+            os.fsync(self._file.fileno())
+            self._pending = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    def lastSeq(self):
+        return self._seq
+
+    def records(self):
+        return read_records(self.path)
+
+    def discard(self, marks):
+        """Drop the records saved in the label files.
+
+        marks is a dict of image -> lastSeq() when its saved state was
+        taken; the records of image made after that are kept.
+        """
+        self.sync()
+        records = [
+            r
+            for r in self.records()
+            if r.get("seq", 0) > marks.get(r["image"], -1)
+        ]
+        self._rewrite(records)
+
+    def _rewrite(self, records):
+        self._file.close()
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, separators=(",", ":")) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._pending = 0
+
+    def compact(self, load_base, save):
+        """Write the journaled state of every image and empty the journal.
+
+        load_base(image) returns the (shapes, mask, size) the records of
+        image apply to; save(image, state) writes an ImageState. Records
+        of images that fail to replay or save are kept.
+        """
+        self.sync()
+        records = self.records()
+        by_image = collections.OrderedDict()
+        for record in records:
+            by_image.setdefault(record["image"], []).append(record)
+        failed = set()
+        for image, image_records in by_image.items():
+            try:
+                save(image, replay(image_records, load_base)[image])
+            except Exception as e:
+                logger.error("Failed to compact journal of %s: %s", image, e)
+                failed.add(image)
+        self._rewrite([r for r in records if r["image"] in failed])
+        return len(by_image) - len(failed), len(failed)
+
+
+def read_records(path):
+    """Return the records of a journal; a truncated last line is ignored."""
+    records = []
+    if not osp.exists(path):
+        return records
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                logger.warning("Ignoring a corrupted journal record in %s", path)
+    return records
+
+
+def replay(records, load_base):
+    """Return a dict of image -> ImageState rebuilt from records."""
+    states = {}
+    for record in records:
+        image = record["image"]
+        if image not in states:
+            states[image] = ImageState(*load_base(image))
+        states[image].apply(record)
+    return states
+
+
+def load_base(image, output_dir=None):
+    """Return the (shapes, mask, size) saved in the label file of image."""
+    label_file = label_file_path(image, output_dir)
+    if not osp.exists(label_file):
+        return [], None, None
+    with open(label_file, encoding="utf-8") as f:
+        data = json.load(f)
+    mask = decode_patch(data.get("patch"))
+    return (
+        list(data.get("shapes", [])),
+        mask,
+        [data.get("imageHeight"), data.get("imageWidth")],
+    )
+
+
+def save_state(image, state, patch_encoding="list", output_dir=None):
+    """Write the ImageState of image to its label file.
+
+    The flags, the embedded image data and the other fields of an existing
+    label file are kept.
+    """
+    label_file = label_file_path(image, output_dir)
+    data = {}
+    if osp.exists(label_file):
+        with open(label_file, encoding="utf-8") as f:
+            data = json.load(f)
+    elif not state.shapes and (state.mask is None or not state.mask.any()):
+        # Nothing left to save, e.g. all the edits were undone.
+        return
+    save_atomic(
+        label_file,
+        patch=None if state.mask is None else encode_patch(state.mask, patch_encoding),
+        shapes=state.shapes,
+        imagePath=osp.relpath(image, osp.dirname(label_file)),
+        imageData=(
+            None
+            if data.get("imageData") is None
+            else base64.b64decode(data["imageData"])
+        ),
+        imageHeight=state.size[0] if state.size else None,
+        imageWidth=state.size[1] if state.size else None,
+        otherData={k: v for k, v in data.items() if k not in _LABEL_FILE_KEYS},
+        flags=data.get("flags", {}),
+    )
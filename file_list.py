@@ -0,0 +1,307 @@
+import collections
+import concurrent.futures
+import functools
+import os
+import os.path as osp
+import threading
+
+from qtpy import QtCore
+from qtpy import QtWidgets
+from qtpy.QtCore import Qt
+
+from labelme.label_file import LabelFile
+from labelme.logger import logger
+
+
+class LabelScanner(object):
+    """Find the images that have a label file by listing label directories.
+
+    The label files of a directory are listed once with os.scandir and
+    the listing is reused for as long as the directory mtime is unchanged,
+    so checking many images costs one stat per directory.
+    """
+
+    def __init__(self, max_workers=8):
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        )
+        self._lock = threading.Lock()
+        self._listings = {}  # key=directory, value=(mtime, label file names)
+
+    def labelNames(self, dirpath):
+        try:
+            mtime = os.stat(dirpath).st_mtime_ns
+        except OSError:
+            return frozenset()
+        with self._lock:
+            listing = self._listings.get(dirpath)
+        if listing is not None and listing[0] == mtime:
+            return listing[1]
+        try:
+            with os.scandir(dirpath) as it:
+                names = frozenset(
+                    e.name for e in it if LabelFile.is_label_file(e.name)
+                )
+        except OSError:
+            names = frozenset()
+        with self._lock:
+            self._listings[dirpath] = (mtime, names)
+        return names
+
+    @staticmethod
+    def _groups(filenames, output_dir):
+        # key=label directory, value=[(image filename, label file name)]
+        groups = collections.defaultdict(list)
+        for filename in filenames:
+            dirname, basename = osp.split(filename)
+            name = osp.splitext(basename)[0] + ".json"
+            groups[output_dir or dirname].append((filename, name))
+        return groups
+
+    def _status(self, dirpath, group):
+        names = self.labelNames(dirpath)
+        return {filename: name in names for filename, name in group}
+
+    def status(self, filenames, output_dir=None):
+        """Return a dict of filename -> whether it has a label file."""
+        status = {}
+        for dirpath, group in self._groups(filenames, output_dir).items():
+            status.update(self._status(dirpath, group))
+        return status
+
+    def scan(self, filenames, output_dir, callback, errback=None):
+        """Check filenames in the pool, a label directory at a time.
+
+        callback is called from the workers with the status of the images
+        of each directory as soon as it is listed. Errors are logged and
+        passed to errback.
+        """
+        for dirpath, group in self._groups(filenames, output_dir).items():
+            future = self._executor.submit(self._status, dirpath, group)
+            future.add_done_callback(
+                functools.partial(self._done, dirpath, callback, errback)
+            )
+
+    @staticmethod
+    def _done(dirpath, callback, errback, future):
+        e = future.exception()
+        if e is None:
+            callback(future.result())
+            return
+        logger.error("Failed to scan the label files of %s: %s", dirpath, e)
+        if errback is not None:
+            errback(e)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+class LabelStatus(QtCore.QObject):
+    """Whether images are labeled, resolved lazily in a worker thread.
+
+    get returns None for an image whose status is unknown; request queues
+    it, and requests are resolved in batches by a LabelScanner looking in
+    output_dir, or next to the images when it is None. changed is emitted
+    with the filenames whose status was set, or None when every status
+    may have changed, and failed with the message of an error.
+    """
+
+    changed = QtCore.Signal(object)
+    failed = QtCore.Signal(str)
+    _resolved = QtCore.Signal(int, object)
+
+    def __init__(self, scanner=None, parent=None):
+        super(LabelStatus, self).__init__(parent)
+        self.scanner = scanner or LabelScanner()
+        self.output_dir = None
+        self._status = {}  # key=filename, value=labeled
+        self._pending = set()  # requested, not submitted yet
+        self._requested = set()  # submitted, not resolved yet
+        self._generation = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(0)
+        self._timer.timeout.connect(self._submit)
+        self._resolved.connect(self._onResolved)
+
+    def get(self, filename):
+        return self._status.get(filename)
+
+    def request(self, filename):
+        if filename in self._pending or filename in self._requested:
+            return
+        self._pending.add(filename)
+        self._timer.start()
+
+    def set(self, filename, labeled):
+        self.update({filename: labeled})
+
+    def update(self, status):
+        self._status.update(status)
+        self._requested.difference_update(status)
+        self.changed.emit(list(status))
+
+    def reset(self, status=None, output_dir=None):
+        """Forget every status, e.g. when the label files moved.
+
+        Resolutions still running are discarded.
+        """
+        self._generation += 1
+        self.output_dir = output_dir
+        self._status = dict(status or {})
+        self._pending.clear()
+        self._requested.clear()
+        self.changed.emit(None)
+
+    def scan(self, filenames):
+        """Resolve the status of filenames in the background.
+
+        Statuses are set a label directory at a time as they come in.
+        """
+        generation = self._generation
+        self.scanner.scan(
+            filenames,
+            self.output_dir,
+            lambda status: self._resolved.emit(generation, status),
+            lambda e: self.failed.emit(str(e)),
+        )
+
+    def _submit(self):
+        batch, self._pending = self._pending, set()
+        self._requested.update(batch)
+        self._executor.submit(self._resolve, self._generation, batch)
+
+    def _resolve(self, generation, batch):
+        try:
+            status = self.scanner.status(batch, self.output_dir)
+        except Exception as e:
+            logger.error("Failed to resolve the label status: %s", e)
+            self.failed.emit(str(e))
+            status = {}
+        self._resolved.emit(generation, status)
+
+    def _onResolved(self, generation, status):
+        if generation == self._generation:
+            self.update(status)
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self.scanner.shutdown()
+
+
+class FileListModel(QtCore.QAbstractListModel):
+    """Image filenames of the file list, checked when they are labeled.
+
+    Filenames are kept in a list along with a filename -> row dict, so
+    looking a filename up is O(1). Check states are read from a
+    LabelStatus when rows are painted; unknown ones show unchecked until
+    they are resolved.
+    """
+
+    def __init__(self, status, parent=None):
+        super(FileListModel, self).__init__(parent)
+        self._filenames = []
+        self._rows = {}  # key=filename, value=row
+        self._status = status
+        self._status.changed.connect(self._onStatusChanged)
+
+    def rowCount(self, parent=QtCore.QModelIndex()):
+        if parent.isValid():
+            return 0
+        return len(self._filenames)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        if role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self._filenames[index.row()]
+        if role == Qt.CheckStateRole:
+            filename = self._filenames[index.row()]
+            labeled = self._status.get(filename)
+            if labeled is None:
+                self._status.request(filename)
+            return Qt.Checked if labeled else Qt.Unchecked
+        return None
+
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.NoItemFlags
+        return Qt.ItemIsEnabled | Qt.ItemIsSelectable
+
+    def filenames(self):
+        """Return the filenames in row order; the list must not be modified."""
+        return self._filenames
+
+    def filename(self, row):
+        return self._filenames[row]
+
+    def findRow(self, filename):
+        """Return the row of filename, or -1."""
+        return self._rows.get(filename, -1)
+
+    def setFilenames(self, filenames):
+        self.beginResetModel()
+        self._filenames = list(filenames)
+        self._rows = {filename: row for row, filename in enumerate(self._filenames)}
+        self.endResetModel()
+
+    def appendFilename(self, filename):
+        row = len(self._filenames)
+        self.beginInsertRows(QtCore.QModelIndex(), row, row)
+        self._filenames.append(filename)
+        self._rows[filename] = row
+        self.endInsertRows()
+
+    def clear(self):
+        self.setFilenames([])
+
+    def setChecked(self, filename, checked):
+        self._status.set(filename, bool(checked))
+
+    def _onStatusChanged(self, filenames):
+        if filenames is None:
+            rows = [0, len(self._filenames) - 1] if self._filenames else []
+        else:
+            rows = [self._rows.get(f, -1) for f in filenames]
+            rows = [row for row in rows if row >= 0]
+        if rows:
+            # One signal for the span; the view only repaints visible rows.
+            self.dataChanged.emit(
+                self.index(min(rows)), self.index(max(rows)), [Qt.CheckStateRole]
+            )
+
+
+class FileListView(QtWidgets.QListView):
+    """Single selection list view of a FileListModel.
+
+    Rows have uniform sizes and are laid out in batches, so only the rows
+    on screen are ever queried and large lists stay responsive.
+    """
+
+    def __init__(self, model, parent=None):
+        super(FileListView, self).__init__(parent)
+        self.setModel(model)
+        self.setSelectionMode(QtWidgets.QAbstractItemView.SingleSelection)
+        self.setUniformItemSizes(True)
+        self.setLayoutMode(QtWidgets.QListView.Batched)
+        self.setBatchSize(1000)
+
+    def currentRow(self):
+        return self.currentIndex().row()
+
+    def setCurrentRow(self, row, notify=True):
+        """Select row; selection signals are only emitted if notify."""
+        selection = self.selectionModel()
+        blocked = selection.blockSignals(not notify)
+        self.setCurrentIndex(self.model().index(row))
+        selection.blockSignals(blocked)
+        if not notify:
+            self.viewport().update()
+
+    def selectedFilename(self):
+        """Return the selected filename, or None."""
+        indexes = self.selectionModel().selectedIndexes()
+        if not indexes:
+            return None
+        return self.model().filename(indexes[0].row())
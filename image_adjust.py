@@ -0,0 +1,166 @@
+import numpy as np
+from qtpy import QtCore
+from qtpy import QtGui
+
+# Weights of ITU-R 601-2 luma, as used by PIL's convert("L").
+LUMA = np.array([0.299, 0.587, 0.114])
+
+
+def qimage_to_array(qimage):
+    """Return a (h, w, 4) RGBA uint8 copy of qimage."""
+    qimage = qimage.convertToFormat(QtGui.QImage.Format_RGBA8888)
+    width, height = qimage.width(), qimage.height()
+    bits = qimage.constBits()
+    if hasattr(bits, "setsize"):  # PyQt's sip.voidptr
+        bits.setsize(qimage.bytesPerLine() * height)
+    rows = np.frombuffer(bits, dtype=np.uint8).reshape(height, qimage.bytesPerLine())
+    return rows[:, : width * 4].reshape(height, width, 4).copy()
+
+
+def array_to_qimage(array):
+    """Return a QImage wrapping a (h, w, 4) RGBA uint8 array, without copy.
+
+    The array is kept alive by the returned image.
+    """
+    array = np.ascontiguousarray(array)
+    height, width = array.shape[:2]
+    qimage = QtGui.QImage(
+        array.data, width, height, width * 4, QtGui.QImage.Format_RGBA8888
+    )
+    qimage._array = array
+    return qimage
+
+
+class BrightnessContrast(object):
+    """Brightness and contrast of an RGBA image through a lookup table.
+
+    The factors mean the same as for PIL.ImageEnhance.Brightness and
+    Contrast applied in this order: both only depend on the value of a
+    channel, and the mean gray level contrast pivots around is derived
+    from per-channel histograms of the source, so an adjustment is a
+    single table lookup per pixel.
+    """
+
+    def __init__(self, array, histograms=None):
+        self.source = np.ascontiguousarray(array, dtype=np.uint8)
+        self._histograms = histograms
+        self._downsampled = None  # (step, BrightnessContrast)
+
+    @classmethod
+    def fromQImage(cls, qimage):
+        return cls(qimage_to_array(qimage))
+
+    @property
+    def width(self):
+        return self.source.shape[1]
+
+    @property
+    def height(self):
+        return self.source.shape[0]
+
+    def downsampled(self, scale):
+        """Return an engine of the image at about scale, for previews.
+
+        It shares the histograms of this one, so that contrast pivots
+        around the same gray level at every scale.
+        """
+        step = int(1.0 / scale) if scale > 0 else 1
+        if step <= 1:
+            return self
+        if self._downsampled is None or self._downsampled[0] != step:
+            self._downsampled = (
+                step,
+                BrightnessContrast(
+                    self.source[::step, ::step], histograms=self.histograms()
+                ),
+            )
+        return self._downsampled[1]
+
+    def histograms(self):
+        """Return the (3, 256) counts of the R, G and B values."""
+        if self._histograms is None:
+            self._histograms = np.stack(
+                [
+                    np.bincount(self.source[..., c].ravel(), minlength=256)
+                    for c in range(3)
+                ]
+            )
+        return self._histograms
+
+    def lut(self, brightness, contrast):
+        """Return the (256,) uint8 table of the R, G and B channels."""
+        values = np.arange(256, dtype=np.float32)
+        table = np.clip(values * brightness, 0, 255).astype(np.uint8)
+        if contrast != 1:
+            counts = self.histograms()
+            means = (counts * table).sum(axis=1) / max(counts[0].sum(), 1)
+            gray = int(means @ LUMA + 0.5)
+            table = np.clip(
+                gray + contrast * (table.astype(np.float32) - gray), 0, 255
+            ).astype(np.uint8)
+        return table
+
+    def apply(self, brightness, contrast):
+        """Return the adjusted (h, w, 4) array; alpha is left unchanged."""
+        table = self.lut(brightness, contrast)
+        out = np.empty_like(self.source)
+        np.take(table, self.source[..., :3], out=out[..., :3], mode="clip")
+        out[..., 3] = self.source[..., 3]
+        return out
+
+    def qimage(self, brightness, contrast):
+        return array_to_qimage(self.apply(brightness, contrast))
+
+
+class ImageAdjustment(QtCore.QObject):
+    """Brightness and contrast of the loaded image.
+
+    Values are the 0-150 slider values of BrightnessContrastDialog, 50
+    meaning unchanged. The source is decoded once per image, when it is
+    first adjusted, and the adjusted image is passed to callback. With
+    coalesce, renders are deferred so that bursts of changes, such as
+    auto-repeated keys, cause at most one render per frame.
+    """
+
+    FRAME_INTERVAL = 16  # ms
+
+    def __init__(self, callback, parent=None):
+        super(ImageAdjustment, self).__init__(parent)
+        self.callback = callback
+        self.brightness = 50
+        self.contrast = 50
+        self._image = None
+        self._engine = None
+        self._timer = QtCore.QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.setInterval(self.FRAME_INTERVAL)
+        self._timer.timeout.connect(self.render)
+
+    def setImage(self, qimage):
+        self._timer.stop()
+        self._image = qimage
+        self._engine = None
+        self.brightness = self.contrast = 50
+
+    def engine(self):
+        if self._engine is None and self._image is not None:
+            self._engine = BrightnessContrast.fromQImage(self._image)
+        return self._engine
+
+    def values(self):
+        return self.brightness, self.contrast
+
+    def setValues(self, brightness, contrast, coalesce=False):
+        self.brightness = 50 if brightness is None else brightness
+        self.contrast = 50 if contrast is None else contrast
+        if not coalesce:
+            self._timer.stop()
+            self.render()
+        elif not self._timer.isActive():
+            self._timer.start()
+
+    def render(self):
+        engine = self.engine()
+        if engine is None:
+            return
+        self.callback(engine.qimage(self.brightness / 50.0, self.contrast / 50.0))
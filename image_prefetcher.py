@@ -0,0 +1,127 @@
+import collections
+import concurrent.futures
+import os
+import os.path as osp
+
+from qtpy import QtGui
+
+from labelme.label_file import LabelFile
+from labelme.logger import logger
+
+# Image and label file of an entry of the image list, read and decoded
+# ahead of time. label_file is None if the image has no label file yet.
+Prefetched = collections.namedtuple(
+    "Prefetched", ["image_data", "image", "label_file", "label_mtime"]
+)
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+def _load(filename, label_file):
+    label_mtime = _mtime(label_file)
+    if label_mtime is not None and LabelFile.is_label_file(label_file):
+        lf = LabelFile(label_file)
+        image_data = lf.imageData
+    else:
+        lf = None
+        image_data = LabelFile.load_image_file(filename)
+    # QImage, unlike QPixmap, can be created outside the GUI thread.
+    image = QtGui.QImage.fromData(image_data)
+    if image.isNull():
+        return None
+    return Prefetched(image_data, image, lf, label_mtime)
+
+
+class ImagePrefetcher(object):
+    """Read and decode images and their label files in worker threads.
+
+    At most max_entries results are kept; the entries furthest from the
+    last requested neighbourhood are dropped first. A result is only
+    handed out if its label file did not change since it was read, so
+    loadFile falls back to reading the file itself whenever a result is
+    missing, stale or failed.
+    """
+
+    def __init__(self, max_workers=2, max_entries=8):
+        self.max_entries = max_entries
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        )
+        self._futures = collections.OrderedDict()  # key=filename
+
+    def prefetch(self, items):
+        """Start loading items, a list of (filename, label_file).
+
+        The items are listed by priority; items already loaded or being
+        loaded are kept.
+        """
+        wanted = set()
+        for filename, label_file in items[: self.max_entries]:
+            wanted.add(filename)
+            if filename in self._futures:
+                self._futures.move_to_end(filename)
+                continue
+            self._futures[filename] = (
+                label_file,
+                self._executor.submit(_load, filename, label_file),
+            )
+        for filename in list(self._futures):
+            if len(self._futures) <= self.max_entries:
+                break
+            if filename not in wanted:
+                self._drop(filename)
+
+    def _drop(self, filename):
+        _, future = self._futures.pop(filename)
+        future.cancel()
+
+    def take(self, filename, label_file):
+        """Return the Prefetched result of filename, or None.
+
+        Waits for the result if it is being loaded, but a load that did
+        not start yet is cancelled instead.
+        """
+        if filename not in self._futures:
+            return None
+        expected_label_file, future = self._futures.pop(filename)
+        if expected_label_file != label_file or future.cancel():
+            return None
+        try:
+            result = future.result()
+        except Exception as e:
+            logger.warning("Failed to prefetch %s: %s", filename, e)
+            return None
+        if result is None or result.label_mtime != _mtime(label_file):
+            return None
+        return result
+
+    def clear(self):
+        for filename in list(self._futures):
+            self._drop(filename)
+
+    def shutdown(self):
+        self.clear()
+        self._executor.shutdown(wait=False)
+
+
+def neighbours(items, index, num_next, num_prev):
+    """Return items after and before index, nearest first."""
+    result = []
+    for offset in range(1, max(num_next, num_prev) + 1):
+        if offset <= num_next and index + offset < len(items):
+            result.append(items[index + offset])
+        if offset <= num_prev and index - offset >= 0:
+            result.append(items[index - offset])
+    return result
+
+
+def label_file_path(filename, output_dir=None):
+    label_file = osp.splitext(filename)[0] + ".json"
+    if output_dir:
+        label_file = osp.join(output_dir, osp.basename(label_file))
+    return label_file
@@ -0,0 +1,128 @@
+import collections
+import concurrent.futures
+import os
+import os.path as osp
+import stat
+import tempfile
+import threading
+
+from qtpy import QtCore
+
+from labelme.label_file import LabelFile
+from labelme.logger import logger
+
+# A label file to write: kwargs are passed to LabelFile.save, along with
+# loaders, a dict of name -> function returning the value of that kwarg,
+# called in the worker. If store_data, the image is read (in the worker)
+# and embedded.
+LabelJob = collections.namedtuple(
+    "LabelJob", ["image_filename", "label_file", "kwargs", "loaders", "store_data"]
+)
+
+# Read once, at import: os.umask can only be queried by setting it, which
+# would race with the writer threads.
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+def _file_mode(filename):
+    """Return the mode of filename, or that of a new file if it is missing."""
+    try:
+        return stat.S_IMODE(os.stat(filename).st_mode)
+    except OSError:
+        return 0o666 & ~_UMASK
+
+
+def save_atomic(filename, **kwargs):
+    """Save a label file through a temporary file renamed over filename.
+
+    A crash or a failed write never leaves a truncated label file behind.
+    """
+    dirname = osp.dirname(filename) or "."
+    if not osp.exists(dirname):
+        os.makedirs(dirname, exist_ok=True)
+    fd, tmp_filename = tempfile.mkstemp(
+        prefix="." + osp.basename(filename), suffix=".tmp", dir=dirname
+    )
+    os.close(fd)
+    try:
+        LabelFile().save(filename=tmp_filename, **kwargs)
+        # mkstemp creates the file readable by its owner only.
+        os.chmod(tmp_filename, _file_mode(filename))
+        os.replace(tmp_filename, filename)
+    except BaseException:
+        if osp.exists(tmp_filename):
+            os.remove(tmp_filename)
+        raise
+
+
+class LabelWriter(QtCore.QObject):
+    """Pool of worker threads writing label files.
+
+    The signals are emitted from the workers and delivered in the thread
+    of the connected receivers. progress is emitted once per finished job
+    with the counts of the current batch; a batch ends when done == total.
+    """
+
+    written = QtCore.Signal(str, str)  # image filename, label file
+    failed = QtCore.Signal(str, str)  # image filename, error message
+    progress = QtCore.Signal(int, int)  # done, total
+
+    def __init__(self, max_workers=4, parent=None):
+        super(LabelWriter, self).__init__(parent)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers
+        )
+        self._lock = threading.Lock()
+        self._done = 0
+        self._total = 0
+        self._pending = {}  # key=label file, value=Future of its last write
+
+    def isBusy(self):
+        with self._lock:
+            return self._done < self._total
+
+    def submit(self, jobs):
+        with self._lock:
+            self._total += len(jobs)
+        for job in jobs:
+            with self._lock:
+                # Writes of the same file are kept in order.
+                previous = self._pending.get(job.label_file)
+                future = self._executor.submit(self._write, job, previous)
+                self._pending[job.label_file] = future
+            future.add_done_callback(
+                lambda f, label_file=job.label_file: self._forget(label_file, f)
+            )
+
+    def _forget(self, label_file, future):
+        with self._lock:
+            if self._pending.get(label_file) is future:
+                del self._pending[label_file]
+
+    def _write(self, job, previous):
+        if previous is not None:
+            concurrent.futures.wait([previous])
+        try:
+            kwargs = dict(job.kwargs)
+            for name, load in job.loaders.items():
+                kwargs[name] = load()
+            if job.store_data:
+                kwargs["imageData"] = LabelFile.load_image_file(job.image_filename)
+            save_atomic(job.label_file, **kwargs)
+        except Exception as e:
+            logger.error("Failed to save %s: %s", job.label_file, e)
+            self.failed.emit(job.image_filename, str(e))
+        else:
+            self.written.emit(job.image_filename, job.label_file)
+        finally:
+            with self._lock:
+                self._done += 1
+                done, total = self._done, self._total
+                if done == total:
+                    self._done = self._total = 0
+            self.progress.emit(done, total)
+
+    def shutdown(self):
+        """Wait for the submitted writes to finish."""
+        self._executor.shutdown(wait=True)
@@ -0,0 +1,80 @@
+import base64
+
+import numpy as np
+
+# Encodings of the "patch" field of label files:
+#   "list": nested [class, intensity] lists, as written by tolist()
+#   "rle":  {"encoding": "rle", "shape": [h, w, 2], "dtype": "uint8",
+#            "data": base64 of runs of equal cells, each run stored as a
+#            varint length followed by the class and intensity bytes}
+PATCH_ENCODINGS = ("list", "rle")
+
+
+def encode_patch(array, encoding="list"):
+    """Return the JSON value of a (h, w, 2) uint8 patch mask."""
+    array = np.asarray(array, dtype=np.uint8)
+    if encoding == "list":
+        return array.tolist()
+    if encoding != "rle":
+        raise ValueError("Unknown patch encoding: {}".format(encoding))
+    cells = array.reshape(-1, 2)
+    data = bytearray()
+    if len(cells):
+        changed = np.nonzero((cells[1:] != cells[:-1]).any(axis=1))[0] + 1
+        starts = np.concatenate([[0], changed])
+        lengths = np.diff(np.concatenate([starts, [len(cells)]]))
+        for length, (class_id, intensity) in zip(
+            lengths.tolist(), cells[starts].tolist()
+        ):
+            while length >= 0x80:
+                data.append((length & 0x7F) | 0x80)
+                length >>= 7
+            data.append(length)
+            data.append(class_id)
+            data.append(intensity)
+    return dict(
+        encoding="rle",
+        shape=list(array.shape),
+        dtype="uint8",
+        data=base64.b64encode(bytes(data)).decode("ascii"),
+    )
+
+
+def decode_patch(value):
+    """Return the uint8 patch mask of a "patch" field, or None.
+
+    Both encodings are detected automatically.
+    """
+    if value is None:
+        return None
+    if not isinstance(value, dict):
+        return np.asarray(value, dtype=np.uint8)
+    if value.get("encoding") != "rle" or value.get("dtype") != "uint8":
+        raise ValueError(
+            "Unsupported patch encoding: {}/{}".format(
+                value.get("encoding"), value.get("dtype")
+            )
+        )
+    shape = tuple(value["shape"])
+    data = base64.b64decode(value["data"])
+    lengths, values = [], []
+    i = 0
+    try:
+        while i < len(data):
+            length, shift = 0, 0
+            while data[i] & 0x80:
+                length |= (data[i] & 0x7F) << shift
+                shift += 7
+                i += 1
+            length |= data[i] << shift
+            lengths.append(length)
+            values.append((data[i + 1], data[i + 2]))
+            i += 3
+    except IndexError:
+        raise ValueError("Patch data is truncated")
+    cells = np.repeat(
+        np.asarray(values, dtype=np.uint8).reshape(-1, 2), lengths, axis=0
+    )
+    if cells.size != int(np.prod(shape)):
+        raise ValueError("Patch data does not match its shape {}".format(shape))
+    return cells.reshape(shape)
@@ -0,0 +1,93 @@
+import functools
+
+import numpy as np
+
+# Patch labels are strings of a class digit followed by an intensity
+# character, e.g. "1q" or "2w"; "00" is clean.
+CLASS_LABELS = {
+    "CLEAN": "00",
+    "class1": "1",
+    "class2": "2",
+    "class3": "3",
+    "class4": "4",
+    "class5": "5",
+    "class6": "6",
+}
+INTENSITY_LABELS = {
+    "CLEAN": "",
+    "BLURRY": "q",
+    "BLOCKAGE": "w",
+}
+INTENSITY_CODES = {"q": 1, "w": 2, "e": 3, "r": 4}
+
+# key=class, value=RGB; intensity 1 (BLURRY) and 2 (BLOCKAGE) differ in alpha
+CLASS_RGB = {
+    1: (0, 255, 255),
+    2: (255, 255, 0),
+    3: (0, 0, 255),
+    4: (0, 255, 0),
+    5: (255, 0, 255),
+    6: (255, 0, 0),
+}
+INTENSITY_ALPHA = {1: 90, 2: 180}
+
+
+def make_label(class_text, intensity_text):
+    """Return the label of a class/intensity combo box selection."""
+    return CLASS_LABELS.get(class_text, "") + INTENSITY_LABELS.get(intensity_text, "")
+
+
+@functools.lru_cache(maxsize=None)
+def label_value(label):
+    """Return the (class, intensity) a label writes into the mask.
+
+    Returns None if label is not a patch label. The result is cached, so
+    each distinct label is parsed once.
+    """
+    if not label:
+        return None
+    if label[0] == "0":
+        return (0, 0)
+    if not label[0].isdigit() or len(label) < 2 or label[1] not in INTENSITY_CODES:
+        return None
+    return (int(label[0]), INTENSITY_CODES[label[1]])
+
+
+def value_code(value):
+    """Return the integer code of a (class, intensity) value.
+
+    The code is class * 256 + intensity, which is also its index in the
+    flattened color lookup table.
+    """
+    return (value[0] << 8) | value[1]
+
+
+def _make_color_lut():
+    lut = np.zeros((256 * 256, 4), dtype=np.uint8)
+    for class_id, rgb in CLASS_RGB.items():
+        for intensity, alpha in INTENSITY_ALPHA.items():
+            lut[value_code((class_id, intensity))] = rgb + (alpha,)
+    return lut
+
+
+# RGBA color of every label code; clean cells are fully transparent.
+COLOR_LUT = _make_color_lut()
+
+
+def colorize(values):
+    """Return the RGBA colors of an array of (class, intensity) values.
+
+    values has shape (..., 2), e.g. a PatchMask array; the result has
+    shape (..., 4).
+    """
+    values = np.asarray(values)
+    codes = (values[..., 0].astype(np.intp) << 8) | values[..., 1]
+    return COLOR_LUT[codes]
+
+
+def label_color(label):
+    """Return the (r, g, b, a) color of a label, or None."""
+    value = label_value(label)
+    if value is None:
+        return None
+    return tuple(int(c) for c in COLOR_LUT[value_code(value)])
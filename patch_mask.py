@@ -0,0 +1,207 @@
+import numpy as np
+
+
+class PatchMask(object):
+    """Class/intensity label of every cell of the patch grid.
+
+    The labels are kept in a contiguous uint8 array of shape
+    (patch_height, patch_width, 2) where the last axis holds
+    (class, intensity). A cell labeled (0, 0) is clean.
+    """
+
+    dtype = np.uint8
+
+    def __init__(self, width, height, data=None):
+        if data is None:
+            self.array = np.zeros((height, width, 2), dtype=self.dtype)
+        else:
+            self.array = np.ascontiguousarray(data, dtype=self.dtype)
+            if self.array.shape != (height, width, 2):
+                raise ValueError(
+                    "Unexpected mask shape: {} (expected {})".format(
+                        self.array.shape, (height, width, 2)
+                    )
+                )
+
+    @property
+    def width(self):
+        return self.array.shape[1]
+
+    @property
+    def height(self):
+        return self.array.shape[0]
+
+    @property
+    def shape(self):
+        return self.array.shape
+
+    def hasSize(self, width, height):
+        return self.array.shape[:2] == (height, width)
+
+    def set(self, rows, cols, value):
+        """Set the cells at (rows, cols) to value=(class, intensity).
+
+        rows and cols may be scalars, index arrays or slices.
+        """
+        self.array[rows, cols] = value
+
+    def fill(self, value=(0, 0)):
+        self.array[...] = value
+
+    def clear(self):
+        self.fill((0, 0))
+
+    def copy(self):
+        return PatchMask(self.width, self.height, data=self.array.copy())
+
+    def changedCells(self, other, cells=None):
+        """Return (rows, cols) of the cells that differ from other.
+
+        cells restricts the comparison to a list of (rows, cols), each an
+        index, index arrays or slices, so that its cost depends on the
+        number of cells written rather than on the size of the mask.
+        """
+        if cells is None:
+            return np.nonzero((self.array != other.array).any(axis=2))
+        height, width = self.array.shape[:2]
+        flat = []
+        for rows, cols in cells:
+            if isinstance(rows, slice) or isinstance(cols, slice):
+                rows = np.arange(height)[rows].reshape(-1, 1)
+                cols = np.arange(width)[cols].reshape(1, -1)
+            rows, cols = np.broadcast_arrays(
+                np.asarray(rows, dtype=np.intp), np.asarray(cols, dtype=np.intp)
+            )
+            flat.append(rows.ravel() * width + cols.ravel())
+        if not flat:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        rows, cols = np.divmod(np.unique(np.concatenate(flat)), width)
+        changed = (self.array[rows, cols] != other.array[rows, cols]).any(axis=1)
+        return rows[changed], cols[changed]
+
+    def tolist(self):
+        return self.array.tolist()
+
+
+class PatchGrid(object):
+    """Mapping between image coordinates and cells of the patch grid.
+
+    The grid has patch_width columns and patch_height rows of
+    (image_width // patch_width) x (image_height // patch_height) pixels.
+    Pixels past the last full cell belong to the last row/column.
+    """
+
+    def __init__(self, image_width, image_height, patch_width, patch_height):
+        self.image_width = image_width
+        self.image_height = image_height
+        self.cols = patch_width
+        self.rows = patch_height
+        self.cell_width = max(image_width // patch_width, 1)
+        self.cell_height = max(image_height // patch_height, 1)
+
+    @property
+    def key(self):
+        return (self.image_width, self.image_height, self.cols, self.rows)
+
+    def _clamp(self, row, col):
+        return (
+            min(max(row, 0), self.rows - 1),
+            min(max(col, 0), self.cols - 1),
+        )
+
+    def cellAt(self, x, y):
+        """Return the (row, col) of the cell containing (x, y)."""
+        return self._clamp(int(y // self.cell_height), int(x // self.cell_width))
+
+    def cellCenter(self, row, col):
+        """Return the (x, y) center of the cell at (row, col)."""
+        return ((col + 0.5) * self.cell_width, (row + 0.5) * self.cell_height)
+
+    def boxCells(self, x0, y0, x1, y1):
+        """Return (rows, cols) slices of the cells touched by a box.
+
+        (x0, y0) is the top-left and (x1, y1) the bottom-right corner.
+        """
+        top, left = self.cellAt(x0, y0)
+        bottom, right = self.cellAt(x1, y1)
+        return slice(top, bottom + 1), slice(left, right + 1)
+
+    def segmentCells(self, x0, y0, x1, y1):
+        """Return the cells crossed by the segment (x0, y0)-(x1, y1), in order.
+
+        The segment is walked in cell space (Amanatides & Woo), so the cost
+        is proportional to the number of cells crossed, not to its length
+        in pixels.
+        """
+        cw, ch = self.cell_width, self.cell_height
+        col, row = int(x0 // cw), int(y0 // ch)
+        col_end, row_end = int(x1 // cw), int(y1 // ch)
+        dx, dy = x1 - x0, y1 - y0
+        step_col = 1 if dx > 0 else -1
+        step_row = 1 if dy > 0 else -1
+        if dx:
+            next_x = (col + (1 if dx > 0 else 0)) * cw
+            t_max_col = (next_x - x0) / dx
+            t_delta_col = cw / abs(dx)
+        else:
+            t_max_col = t_delta_col = float("inf")
+        if dy:
+            next_y = (row + (1 if dy > 0 else 0)) * ch
+            t_max_row = (next_y - y0) / dy
+            t_delta_row = ch / abs(dy)
+        else:
+            t_max_row = t_delta_row = float("inf")
+
+        cells = [self._clamp(row, col)]
+        for _ in range(abs(col_end - col) + abs(row_end - row)):
+            if t_max_col < t_max_row:
+                col += step_col
+                t_max_col += t_delta_col
+            else:
+                row += step_row
+                t_max_row += t_delta_row
+            cell = self._clamp(row, col)
+            if cell != cells[-1]:
+                cells.append(cell)
+        return cells
+
+    def strokeCells(self, points):
+        """Return (rows, cols) of the unique cells touched by a stroke.
+
+        points is a sequence of (x, y); cells are in the order they were
+        first touched.
+        """
+        cells = CellSet()
+        if len(points) == 1:
+            cells.add(self.cellAt(*points[0]))
+        for (x0, y0), (x1, y1) in zip(points[:-1], points[1:]):
+            cells.update(self.segmentCells(x0, y0, x1, y1))
+        return cells.arrays()
+
+
+class CellSet(object):
+    """Ordered set of (row, col) cells."""
+
+    def __init__(self):
+        self._cells = []
+        self._seen = set()
+
+    def __len__(self):
+        return len(self._cells)
+
+    def add(self, cell):
+        if cell in self._seen:
+            return False
+        self._seen.add(cell)
+        self._cells.append(cell)
+        return True
+
+    def update(self, cells):
+        """Add cells and return the ones that were not in the set yet."""
+        return [cell for cell in cells if self.add(cell)]
+
+    def arrays(self):
+        if not self._cells:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        rows, cols = zip(*self._cells)
+        return np.array(rows, dtype=np.intp), np.array(cols, dtype=np.intp)
@@ -0,0 +1,74 @@
+import numpy as np
+from qtpy import QtCore
+from qtpy import QtGui
+
+from .patch_labels import colorize
+
+
+class PatchOverlay(object):
+    """Colored patch mask as a small RGBA image with one pixel per cell.
+
+    Only the cells that changed are recolored, and the whole overlay is
+    drawn with a single scaled drawImage call, so painting does not
+    depend on how many cells are labeled.
+    """
+
+    def __init__(self):
+        self._rgba = None
+        self._image = None
+
+    def invalidate(self):
+        self._rgba = None
+        self._image = None
+
+    def rebuild(self, mask):
+        self._rgba = np.ascontiguousarray(colorize(mask.array))
+        self._image = None
+
+    def update(self, mask, rows, cols):
+        """Recolor the cells at (rows, cols) from mask."""
+        if self._rgba is None or self._rgba.shape[:2] != mask.shape[:2]:
+            self.rebuild(mask)
+            return
+        self._rgba[rows, cols] = colorize(mask.array[rows, cols])
+        self._image = None
+
+    def image(self, mask):
+        if self._rgba is None or self._rgba.shape[:2] != mask.shape[:2]:
+            self.rebuild(mask)
+        if self._image is None:
+            height, width = self._rgba.shape[:2]
+            # Wraps self._rgba without copying it.
+            self._image = QtGui.QImage(
+                self._rgba.data,
+                width,
+                height,
+                self._rgba.strides[0],
+                QtGui.QImage.Format_RGBA8888,
+            )
+        return self._image
+
+    def paint(self, painter, mask, grid, clip=None):
+        """Draw the overlay in image coordinates.
+
+        If clip (an image-space QRectF) is given, only the cells it
+        intersects are drawn.
+        """
+        left, top = 0, 0
+        right, bottom = grid.cols, grid.rows
+        if clip is not None:
+            top, left = grid.cellAt(clip.left(), clip.top())
+            bottom, right = grid.cellAt(clip.right(), clip.bottom())
+            bottom, right = bottom + 1, right + 1
+        target = QtCore.QRectF(
+            left * grid.cell_width,
+            top * grid.cell_height,
+            (right - left) * grid.cell_width,
+            (bottom - top) * grid.cell_height,
+        )
+        source = QtCore.QRectF(left, top, right - left, bottom - top)
+        smooth = painter.testRenderHint(QtGui.QPainter.SmoothPixmapTransform)
+        # Cells must stay sharp when scaled up.
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, False)
+        painter.drawImage(target, self.image(mask), source)
+        painter.setRenderHint(QtGui.QPainter.SmoothPixmapTransform, smooth)
@@ -0,0 +1,190 @@
+import atexit
+import collections
+import collections.abc
+import hashlib
+import io
+import json
+import os
+import os.path as osp
+import shutil
+import tempfile
+
+import numpy as np
+from qtpy import QtCore
+from qtpy import QtGui
+
+# How the values of a SpillStore are written to and read back from disk,
+# and how much memory a value holds.
+Codec = collections.namedtuple("Codec", ["encode", "decode", "sizeof", "suffix"])
+
+
+def _json_encode(value):
+    return json.dumps(value, separators=(",", ":")).encode("utf-8")
+
+
+def _json_decode(data):
+    return json.loads(data.decode("utf-8"))
+
+
+def _array_encode(value):
+    buffer = io.BytesIO()
+    np.save(buffer, value, allow_pickle=False)
+    return buffer.getvalue()
+
+
+def _array_decode(data):
+    return np.load(io.BytesIO(data), allow_pickle=False)
+
+
+def _pixmap_encode(value):
+    array = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(array)
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    value.save(buffer, "PNG")
+    buffer.close()
+    return bytes(array)
+
+
+def _pixmap_decode(data):
+    pixmap = QtGui.QPixmap()
+    pixmap.loadFromData(data, "PNG")
+    return pixmap
+
+
+# Approximate sizes of a shape dict, of each of its points and of each of
+# its patch cells, serialized.
+_SHAPE_NBYTES = 160
+_POINT_NBYTES = 40
+_CELL_NBYTES = 12
+
+
+def _json_sizeof(value):
+    """Estimate the size of value, without serializing it.
+
+    Lists of shape dicts, as stored for the queued label files, are sized
+    from their point and cell counts; other values are serialized.
+    """
+    if not isinstance(value, list) or not all(isinstance(v, dict) for v in value):
+        return len(_json_encode(value))
+    nbytes = 2
+    for shape in value:
+        mask = shape.get("mask")
+        nbytes += (
+            _SHAPE_NBYTES
+            + _POINT_NBYTES * len(shape.get("points") or ())
+            + _CELL_NBYTES * len(shape.get("patch_cells") or ())
+            + (len(mask) if isinstance(mask, str) else 0)
+        )
+    return nbytes
+
+
+JSON_CODEC = Codec(_json_encode, _json_decode, _json_sizeof, ".json")
+ARRAY_CODEC = Codec(_array_encode, _array_decode, lambda v: v.nbytes, ".npy")
+PIXMAP_CODEC = Codec(
+    _pixmap_encode,
+    _pixmap_decode,
+    lambda v: v.width() * v.height() * v.depth() // 8,
+    ".png",
+)
+
+
+class SpillStore(collections.abc.MutableMapping):
+    """Dict that keeps at most max_nbytes of values in memory.
+
+    The least recently used values over the budget are written to files in
+    a session directory and read back, transparently, when they are
+    accessed again. Their files are removed when the store is cleared,
+    and the directory when the process exits.
+    """
+
+    def __init__(self, codec, max_nbytes=64 * 1024 * 1024):
+        self.codec = codec
+        self.max_nbytes = max_nbytes
+        self.nbytes = 0
+        self._memory = collections.OrderedDict()  # key=key, value=(value, nbytes)
+        self._spilled = {}  # key=key, value=path
+        self._directory = None
+
+    def __contains__(self, key):
+        return key in self._memory or key in self._spilled
+
+    def __getitem__(self, key):
+        if key in self._memory:
+            self._memory.move_to_end(key)
+            return self._memory[key][0]
+        path = self._spilled[key]
+        with open(path, "rb") as f:
+            value = self.codec.decode(f.read())
+        self[key] = value
+        return value
+
+    def __setitem__(self, key, value):
+        self._discard(key)
+        nbytes = self.codec.sizeof(value)
+        self._memory[key] = (value, nbytes)
+        self.nbytes += nbytes
+        self._trim()
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self._discard(key)
+
+    def __iter__(self):
+        return iter(list(self._memory) + list(self._spilled))
+
+    def __len__(self):
+        return len(self._memory) + len(self._spilled)
+
+    def take(self, key):
+        """Remove key and return a function returning its value.
+
+        A spilled value is not read back into memory: the function reads
+        it, e.g. in a worker thread, and then deletes its file.
+        """
+        if key in self._memory:
+            value, nbytes = self._memory.pop(key)
+            self.nbytes -= nbytes
+            return lambda: value
+        path = self._spilled.pop(key)
+        decode = self.codec.decode
+
+        def load():
+            with open(path, "rb") as f:
+                data = f.read()
+            os.remove(path)
+            return decode(data)
+
+        return load
+
+    def clear(self):
+        self._memory.clear()
+        self.nbytes = 0
+        # Files of taken values may still be waiting to be read.
+        for path in self._spilled.values():
+            os.remove(path)
+        self._spilled.clear()
+
+    def _discard(self, key):
+        if key in self._memory:
+            self.nbytes -= self._memory.pop(key)[1]
+        path = self._spilled.pop(key, None)
+        if path is not None:
+            os.remove(path)
+
+    def _path(self, key):
+        if self._directory is None:
+            self._directory = tempfile.mkdtemp(prefix="labelme-session-")
+            atexit.register(shutil.rmtree, self._directory, True)
+        name = hashlib.sha1(str(key).encode("utf-8")).hexdigest()
+        return osp.join(self._directory, name + self.codec.suffix)
+
+    def _trim(self):
+        # The most recent value always stays in memory.
+        while self.nbytes > self.max_nbytes and len(self._memory) > 1:
+            key, (value, nbytes) = self._memory.popitem(last=False)
+            path = self._path(key)
+            with open(path, "wb") as f:
+                f.write(self.codec.encode(value))
+            self._spilled[key] = path
+            self.nbytes -= nbytes
@@ -0,0 +1,200 @@
+import collections
+
+import numpy as np
+
+# Rough memory held by one QPointF kept alive by the undo stack.
+POINT_NBYTES = 64
+# Rough memory held by one shape record, excluding its points.
+SHAPE_NBYTES = 512
+
+
+class ShapeState(collections.namedtuple("ShapeState", ["points", "label"])):
+    """Part of a shape that an edit can change in place."""
+
+    @classmethod
+    def of(cls, shape):
+        return cls(tuple(shape.points), shape.label)
+
+    def apply(self, shape):
+        shape.points = list(self.points)
+        shape.label = self.label
+
+
+class Edit(object):
+    """Changes made by one canvas edit.
+
+    Only what changed is recorded: the mask cells with their old and new
+    values, the shapes that were added or removed, and the old and new
+    points/label of the shapes that were modified in place.
+    """
+
+    def __init__(self):
+        self.cells = []  # (rows, cols, old, new)
+        self.added = []  # (index, shape) in the shape list after the edit
+        self.removed = []  # (index, shape) in the shape list before the edit
+        self.modified = []  # (shape, old ShapeState, new ShapeState)
+        self.order = None  # shape list before the edit, if it was reordered
+        self.merged = []  # edits merged into this one, in order
+        self.nbytes = 0
+
+    def isEmpty(self):
+        return not (
+            self.cells
+            or self.added
+            or self.removed
+            or self.modified
+            or self.order is not None
+            or self.merged
+        )
+
+    def _updateNbytes(self):
+        nbytes = 0
+        for rows, cols, old, new in self.cells:
+            nbytes += rows.nbytes + cols.nbytes + old.nbytes + new.nbytes
+        for _, shape in self.added + self.removed:
+            nbytes += SHAPE_NBYTES + POINT_NBYTES * len(shape.points)
+        for _, old, new in self.modified:
+            nbytes += SHAPE_NBYTES + POINT_NBYTES * (len(old.points) + len(new.points))
+        if self.order is not None:
+            nbytes += 8 * len(self.order)
+        self.nbytes = nbytes
+
+    @classmethod
+    def diff(
+        cls,
+        shapes_before,
+        states_before,
+        mask_before,
+        shapes_after,
+        mask_after,
+        cells=None,
+        touched=None,
+    ):
+        """Record the changes from a committed state to the current one.
+
+        states_before maps each shape of shapes_before to its ShapeState.
+        cells lists the (rows, cols) written in the mask and touched the
+        shapes that may have been modified in place since; when None, the
+        whole mask or every shape is compared.
+        """
+        edit = cls()
+        rows, cols = mask_after.changedCells(mask_before, cells)
+        if len(rows):
+            edit.cells.append(
+                (
+                    rows,
+                    cols,
+                    mask_before.array[rows, cols].copy(),
+                    mask_after.array[rows, cols].copy(),
+                )
+            )
+
+        before = set(shapes_before)
+        after = set(shapes_after)
+        edit.removed = [(i, s) for i, s in enumerate(shapes_before) if s not in after]
+        edit.added = [(i, s) for i, s in enumerate(shapes_after) if s not in before]
+        kept_before = [s for s in shapes_before if s in after]
+        kept_after = [s for s in shapes_after if s in before]
+        if kept_before != kept_after:
+            edit.order = list(shapes_before)
+        if touched is not None:
+            kept_after = [s for s in touched if s in before and s in after]
+        for shape in kept_after:
+            old = states_before[shape]
+            if shape.label != old.label or shape.points != list(old.points):
+                edit.modified.append((shape, old, ShapeState.of(shape)))
+        edit._updateNbytes()
+        return edit
+
+    def merge(self, other):
+        """Append other, an edit made right after this one.
+
+        Both are then undone together, other first.
+        """
+        self.merged.append(other)
+        self.nbytes += other.nbytes
+
+    def revert(self, shapes, masks):
+        """Undo the edit.
+
+        The cell changes are reverted in each of masks, and the shape
+        list before the edit is returned.
+        """
+        for edit in reversed(self.merged):
+            shapes = edit.revert(shapes, masks)
+        for rows, cols, old, _ in reversed(self.cells):
+            for mask in masks:
+                mask.array[rows, cols] = old
+        for shape, old, _ in reversed(self.modified):
+            old.apply(shape)
+        if self.order is not None:
+            return list(self.order)
+        added = {id(s) for _, s in self.added}
+        shapes = [s for s in shapes if id(s) not in added]
+        for index, shape in sorted(self.removed, key=lambda x: x[0]):
+            shapes.insert(index, shape)
+        return shapes
+
+    def shapes(self):
+        """Return the shapes added, removed or modified by the edit."""
+        shapes = [s for _, s in self.added + self.removed]
+        shapes += [s for s, _, _ in self.modified]
+        for edit in self.merged:
+            shapes += edit.shapes()
+        return shapes
+
+    def changedCells(self):
+        """Return (rows, cols) of all the cells changed by the edit."""
+        cells = list(self.cells)
+        for edit in self.merged:
+            cells.append(edit.changedCells() + (None, None))
+        if not cells:
+            return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.intp)
+        rows = np.concatenate([c[0] for c in cells])
+        cols = np.concatenate([c[1] for c in cells])
+        return rows, cols
+
+
+class UndoStack(object):
+    """Stack of Edits bounded by the memory they hold, not by their count.
+
+    The oldest edits are dropped once the stack holds more than max_nbytes,
+    but the latest edit is always kept.
+    """
+
+    def __init__(self, max_nbytes):
+        self.max_nbytes = max_nbytes
+        self._edits = collections.deque()
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._edits)
+
+    def clear(self):
+        self._edits.clear()
+        self.nbytes = 0
+
+    def push(self, edit):
+        self._edits.append(edit)
+        self.nbytes += edit.nbytes
+        self._trim()
+
+    def merge(self, edit):
+        """Merge edit into the latest edit, or push it if there is none."""
+        if not self._edits:
+            self.push(edit)
+            return
+        last = self._edits[-1]
+        self.nbytes -= last.nbytes
+        last.merge(edit)
+        self.nbytes += last.nbytes
+        self._trim()
+
+    def pop(self):
+        edit = self._edits.pop()
+        self.nbytes -= edit.nbytes
+        return edit
+
+    def _trim(self):
+        while self.nbytes > self.max_nbytes and len(self._edits) > 1:
+            self.nbytes -= self._edits.popleft().nbytes